@@ -2,10 +2,112 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import atexit
+import json
+import logging
 import os
+import threading
+import time
 
-from rpaas import manager
+from rpaas import manager, storage, consul_manager
+
+_manager = None
+_manager_pid = None
+_manager_config_mtime = None
+_manager_lock = threading.Lock()
+_config_checked = 0
 
 
 def get_manager():
-    return manager.Manager(dict(os.environ))
+    """
+    Returns the Manager shared by every request served by this process.
+
+    The manager is built lazily, so each forked worker gets its own instance
+    (and its own connection pools) on first use. It is built again when the
+    file in RPAAS_CONFIG_FILE changes.
+    """
+    global _manager, _manager_pid
+    pid = os.getpid()
+    if _manager is None or _manager_pid != pid or _config_changed():
+        with _manager_lock:
+            if _manager is None or _manager_pid != pid or _config_file_mtime() != _manager_config_mtime:
+                _build_manager()
+    return _manager
+
+
+def reload_manager():
+    """
+    Replaces the shared Manager with a new one built from the current
+    configuration. Requests already holding the old manager finish with it.
+    """
+    with _manager_lock:
+        return _build_manager()
+
+
+def load_config():
+    """
+    Configuration of the Manager: the environment, overridden by the JSON
+    object stored in RPAAS_CONFIG_FILE, which unlike the environment can
+    change while the process runs.
+    """
+    config = dict(os.environ)
+    path = config.get("RPAAS_CONFIG_FILE")
+    if path and os.path.exists(path):
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def _build_manager():
+    global _manager, _manager_pid, _manager_config_mtime
+    mtime = _config_file_mtime()
+    try:
+        config = load_config()
+    except ValueError as e:
+        if _manager is None or _manager_pid != os.getpid():
+            raise
+        # a broken file keeps the current manager until it changes again
+        logging.error("invalid configuration in {}: {}".format(os.environ.get("RPAAS_CONFIG_FILE"), e))
+        _manager_config_mtime = mtime
+        return _manager
+    _manager = manager.Manager(config)
+    _manager_pid = os.getpid()
+    _manager_config_mtime = mtime
+    return _manager
+
+
+def _config_file_mtime():
+    path = os.environ.get("RPAAS_CONFIG_FILE")
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _config_changed():
+    global _config_checked
+    now = time.time()
+    if now - _config_checked < float(os.environ.get("RPAAS_CONFIG_CHECK_INTERVAL", 5)):
+        return False
+    _config_checked = now
+    return _config_file_mtime() != _manager_config_mtime
+
+
+def close_manager():
+    """
+    Drops the shared Manager and closes the process-wide Mongo and Consul
+    clients. The next call to get_manager builds everything again.
+    """
+    global _manager, _manager_pid, _manager_config_mtime
+    with _manager_lock:
+        _manager = None
+        _manager_pid = None
+        _manager_config_mtime = None
+    storage.clients.clear()
+    consul_manager.clients.clear()
+    consul_manager.node_indexes.clear()
+
+
+atexit.register(close_manager)
@@ -3,11 +3,13 @@
 # license that can be found in the LICENSE file.
 
 import json
+import os
 from bson import json_util
 
 from flask import request, Response
 
-from rpaas import auth, get_manager, storage, plan, flavor
+from rpaas import auth, cache, consul_manager, get_manager, nginx, storage, plan, flavor
+from rpaas.manager import parse_max_unavailable
 
 
 @auth.required
@@ -142,8 +144,44 @@ def restore_instance():
     instance_name = request.form.get("instance_name")
     if not instance_name:
         return "instance name required", 400
+    max_unavailable = request.form.get("max_unavailable")
+    if max_unavailable:
+        try:
+            parse_max_unavailable(max_unavailable)
+        except ValueError as e:
+            return str(e), 400
     manager = get_manager()
-    return Response(manager.restore_instance(instance_name), content_type='event/stream')
+    return Response(manager.restore_instance(instance_name, max_unavailable), content_type='event/stream')
+
+
+@auth.required
+def indexes():
+    manager = get_manager()
+    if request.method == "POST":
+        manager.storage.ensure_indexes()
+    return json.dumps({"missing": manager.storage.missing_indexes(),
+                       "plans": manager.storage.query_plans()})
+
+
+@auth.required
+def migrate_upstreams():
+    instance_name = request.form.get("instance_name")
+    if not instance_name:
+        return "instance name required", 400
+    manager = get_manager()
+    try:
+        migrated = manager.migrate_upstreams(instance_name)
+    except storage.InstanceNotFoundError:
+        return "instance not found", 404
+    return json.dumps({"migrated": migrated})
+
+
+@auth.required
+def stats():
+    return json.dumps({"pid": os.getpid(),
+                       "consul_cas": consul_manager.cas_stats.stats(),
+                       "nginx_retries": nginx.retry_stats.stats(),
+                       "lb_cache": cache.load_balancers.stats()})
 
 
 def register_views(app, list_plans, list_flavors):
@@ -175,3 +213,9 @@ def register_views(app, list_plans, list_flavors):
                      view_func=set_team_quota)
     app.add_url_rule("/admin/restore", methods=["POST"],
                      view_func=restore_instance)
+    app.add_url_rule("/admin/indexes", methods=["GET", "POST"],
+                     view_func=indexes)
+    app.add_url_rule("/admin/upstreams/migrate", methods=["POST"],
+                     view_func=migrate_upstreams)
+    app.add_url_rule("/admin/stats", methods=["GET"],
+                     view_func=stats)
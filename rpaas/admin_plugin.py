@@ -281,9 +281,14 @@ def list_healings(args):
 def restore_instance(args):
     parser = _base_args("restore-instance")
     parser.add_argument("-i", "--instance", required=True)
+    parser.add_argument("-u", "--max-unavailable", required=False,
+                        help="Hosts restored at once, as a count or a percentage (e.g. 25%%)")
     parsed_args = parser.parse_args(args)
+    params = {"instance_name": parsed_args.instance}
+    if parsed_args.max_unavailable:
+        params["max_unavailable"] = parsed_args.max_unavailable
     result = proxy_request(parsed_args.service, "/admin/restore", method="POST",
-                           body=urllib.urlencode({"instance_name": parsed_args.instance}),
+                           body=urllib.urlencode(params),
                            headers={"Content-Type": "application/x-www-form-urlencoded"})
     if result.getcode() == 200:
         for msg in parser_result(result):
@@ -294,6 +299,46 @@ def restore_instance(args):
         sys.exit(1)
 
 
+def indexes(args):
+    parser = _base_args("indexes")
+    parser.add_argument("-c", "--create", action="store_true",
+                        help="Create the missing indexes before reporting")
+    parsed_args = parser.parse_args(args)
+    result = proxy_request(parsed_args.service, "/admin/indexes",
+                           method="POST" if parsed_args.create else "GET")
+    body = result.read().rstrip("\n")
+    if result.getcode() != 200:
+        sys.stderr.write("ERROR: " + body + "\n")
+        sys.exit(1)
+    report = json.loads(body)
+    for index in report["missing"]:
+        keys = ", ".join("{} {}".format(field, direction) for field, direction in index["keys"])
+        sys.stdout.write("Missing index on {}: {}\n".format(index["collection"], keys))
+    plans_table = DisplayTable(['Method', 'Collection', 'Plan', 'Indexes'])
+    for plan in report["plans"]:
+        plans_table.add_row(plan["method"], plan["collection"], " <- ".join(plan["stages"]),
+                            ", ".join(plan["indexes"]))
+    plans_table.display()
+
+
+def migrate_upstreams(args):
+    parser = _base_args("migrate-upstreams")
+    parser.add_argument("-i", "--instance", required=True)
+    parsed_args = parser.parse_args(args)
+    result = proxy_request(parsed_args.service, "/admin/upstreams/migrate", method="POST",
+                           body=urllib.urlencode({"instance_name": parsed_args.instance}),
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+    body = result.read().rstrip("\n")
+    if result.getcode() != 200:
+        sys.stderr.write("ERROR: " + body + "\n")
+        sys.exit(1)
+    migrated = json.loads(body)["migrated"]
+    if not migrated:
+        sys.stdout.write("No upstream to migrate.\n")
+        return
+    sys.stdout.write("Migrated upstreams: {}.\n".format(", ".join(sorted(migrated))))
+
+
 def parser_result(fileobj, buffersize=1):
     for chunk in iter(partial(fileobj.read, buffersize), ''):
         yield chunk
@@ -325,7 +370,9 @@ def available_commands():
         "show-quota": show_quota,
         "set-quota": set_quota,
         "list-healings": list_healings,
-        "restore-instance": restore_instance
+        "restore-instance": restore_instance,
+        "indexes": indexes,
+        "migrate-upstreams": migrate_upstreams
     }
 
 
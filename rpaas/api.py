@@ -37,6 +37,15 @@ if SENTRY_DSN:
     api.config['SENTRY_DSN'] = SENTRY_DSN
     sentry = Sentry(api)
 
+if check_option_enable(os.environ.get("RPAAS_ENSURE_INDEXES")):
+    get_manager().storage.ensure_indexes()
+
+if check_option_enable(os.environ.get("RPAAS_BACKFILL_INSTANCE_TEAMS")):
+    get_manager().storage.backfill_instance_teams()
+
+if check_option_enable(os.environ.get("RPAAS_MIGRATE_BINDINGS")):
+    get_manager().storage.migrate_bindings()
+
 if check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")):
     from rpaas.healing import RestoreMachine
     RestoreMachine().start()
@@ -392,12 +401,51 @@ def purge_location(name):
     if not path:
         return 'missing required path', 400
     try:
-        instances_purged = get_manager().purge_location(name, path, preserve_path)
+        purge_results = get_manager().purge_location(name, path, preserve_path)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    except tasks.NotReadyError as e:
+        return "Instance not ready: {}".format(e), 412
+    return purge_report(purge_results), 200
+
+
+@api.route("/resources/<name>/purge/bulk", methods=["POST"])
+def purge_locations(name):
+    paths = request.form.getlist('path')
+    preserve_path = request.form.get('preserve_path')
+    if preserve_path in (False, 'False'):
+        preserve_path = False
+    if not paths:
+        return 'missing required path', 400
+    try:
+        purge_results = get_manager().purge_locations(name, paths, preserve_path)
     except storage.InstanceNotFoundError:
         return "Instance not found", 404
     except tasks.NotReadyError as e:
         return "Instance not ready: {}".format(e), 412
-    return "Path found and purged on {} servers".format(instances_purged), 200
+    return bulk_purge_report(purge_results), 200
+
+
+def bulk_purge_report(purge_results):
+    lines = []
+    for path in sorted(purge_results):
+        hosts = purge_results[path]
+        purged_hosts = [host for host, variants in hosts.items() if "purged" in variants.values()]
+        lines.append("{}: purged on {} of {} servers".format(path, len(purged_hosts), len(hosts)))
+        timed_out = sorted(host for host, variants in hosts.items() if "timeout" in variants.values())
+        if timed_out:
+            lines.append("{}: timed out on {}".format(path, ", ".join(timed_out)))
+    return "\n".join(lines)
+
+
+def purge_report(purge_results):
+    purged_hosts = [host for host, variants in purge_results.items() if "purged" in variants.values()]
+    lines = ["Path found and purged on {} servers".format(len(purged_hosts))]
+    for host in sorted(purge_results):
+        variants = purge_results[host]
+        lines.append("{}: {}".format(host, ", ".join("{} {}".format(variant, variants[variant])
+                                                     for variant in sorted(variants))))
+    return "\n".join(lines)
 
 
 @api.route("/resources/<name>/ssl", methods=["POST"])
@@ -0,0 +1,54 @@
+# Copyright 2016 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    TTLCache is an in-memory cache shared by the whole process, whose
+    entries are only served while younger than the ttl given on lookup and
+    stored with the same version the lookup asks for.
+
+    Entries found with another version are dropped. It keeps hit, miss
+    and invalidation counters, reported by stats().
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, ttl, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] != version:
+                del self.entries[key]
+                self.invalidations += 1
+            elif entry is not None and time.time() - entry[0] < ttl:
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        return None
+
+    def set(self, key, value, version=None):
+        self.entries[key] = (time.time(), version, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "invalidations": self.invalidations}
+
+
+# load balancers by instance name, filled by Manager and versioned by the
+# instance load balancer stamp kept in MongoDB, which every API operation and
+# task changing the instance host set bumps.
+load_balancers = TTLCache()
@@ -2,11 +2,19 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import consul
+import base64
+import contextlib
+import json
+import logging
 import os
+import random
+import threading
+import time
+
+import consul
 
 from . import nginx
-from misc import host_from_destination
+from misc import host_from_destination, ProcessCache
 
 ACL_TEMPLATE = """key "{service_name}/{instance_name}" {{
     policy = "read"
@@ -22,6 +30,10 @@ service "nginx" {{
 """
 
 
+clients = ProcessCache(lambda host, port, token: consul.Consul(host=host, port=port, token=token),
+                       close=lambda client: client.http.session.close())
+
+
 class InstanceAlreadySwappedError(Exception):
     pass
 
@@ -30,15 +42,189 @@ class CertificateNotFoundError(Exception):
     pass
 
 
+class TransactionError(Exception):
+    pass
+
+
+class TransactionConflictError(TransactionError):
+    pass
+
+
+class UpstreamConflictError(Exception):
+    pass
+
+
+class CasStats(object):
+    """
+    Counters for check-and-set updates of upstreams, reported by stats().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters = {"attempts": 0, "conflicts": 0, "exhausted": 0}
+
+    def stats(self):
+        return dict(self.counters)
+
+
+cas_stats = CasStats()
+
+
+class NodeIndex(object):
+    """
+    Index of the Consul catalog by node address, rebuilt from a single
+    catalog read when older than the ttl given on lookup. Unknown addresses
+    trigger a reload, at most once every ``miss_interval`` seconds.
+    """
+
+    def __init__(self, miss_interval=1):
+        self.miss_interval = miss_interval
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.loaded_at = None
+
+    def get(self, client, address, ttl):
+        now = time.time()
+        if self.loaded_at is None or now - self.loaded_at >= ttl:
+            self.load(client)
+        elif address not in self.nodes and now - self.loaded_at >= self.miss_interval:
+            self.load(client)
+        return self.nodes.get(address)
+
+    def load(self, client):
+        with self.lock:
+            _, nodes = client.catalog.nodes()
+            self.nodes = dict((node['Address'], node['Node']) for node in nodes)
+            self.loaded_at = time.time()
+
+    def discard(self, node_name):
+        with self.lock:
+            self.nodes = dict((address, node) for address, node in self.nodes.items() if node != node_name)
+
+
+node_indexes = ProcessCache(lambda host, port, token: NodeIndex())
+
+
+class Transaction(object):
+    """
+    KV operations collected to be committed together.
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def put(self, key, value, cas=None):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        op = {"Verb": "set", "Key": key, "Value": base64.b64encode(value or "")}
+        if cas is not None:
+            op["Verb"] = "cas"
+            op["Index"] = cas
+        self.ops.append(op)
+
+    def delete(self, key, recurse=False, cas=None):
+        op = {"Verb": "delete-tree" if recurse else "delete", "Key": key}
+        if cas is not None:
+            op["Verb"] = "delete-cas"
+            op["Index"] = cas
+        self.ops.append(op)
+
+    def chunks(self, size):
+        for i in xrange(0, len(self.ops), size):
+            yield self.ops[i:i + size]
+
+
 class ConsulManager(object):
 
     def __init__(self, config):
         host = config.get("CONSUL_HOST")
         port = int(config.get("CONSUL_PORT", "8500"))
         token = config.get("CONSUL_TOKEN")
-        self.client = consul.Consul(host=host, port=port, token=token)
+        self.client = clients.get(host, port, token)
+        self.node_index = node_indexes.get(host, port, token)
+        self.node_index_ttl = int(config.get("CONSUL_NODE_INDEX_TTL", "30"))
         self.config_manager = nginx.ConfigManager(config)
         self.service_name = config.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.txn_max_ops = int(config.get("CONSUL_TXN_MAX_OPS", "64"))
+        self.txn_supported = True
+        self.cas_retries = int(config.get("CONSUL_CAS_RETRIES", "5"))
+        self.cas_backoff = float(config.get("CONSUL_CAS_BACKOFF", "0.05"))
+        self.upstream_layout = config.get("CONSUL_UPSTREAM_LAYOUT", "value")
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Groups every KV write issued in the block in a single call to
+        /v1/txn. Nested blocks join the outermost transaction.
+        """
+        txn = getattr(self.local, "txn", None)
+        if txn is not None:
+            yield txn
+            return
+        txn = self.local.txn = Transaction()
+        try:
+            yield txn
+        finally:
+            self.local.txn = None
+        self._commit(txn)
+
+    def _commit(self, txn):
+        for ops in txn.chunks(self.txn_max_ops):
+            if self.txn_supported:
+                params = {}
+                if self.client.token:
+                    params["token"] = self.client.token
+                self.txn_supported = self.client.http.put(self._txn_result, "/v1/txn", params=params,
+                                                          data=json.dumps([{"KV": op} for op in ops]))
+            if not self.txn_supported:
+                self._apply(ops)
+
+    def _txn_result(self, response):
+        if response.code == 200:
+            return True
+        if response.code == 404:
+            return False
+        if response.code == 403:
+            raise consul.ACLPermissionDenied(response.body)
+        errors = response.body
+        if response.code == 409:
+            errors = "; ".join(error.get("What", "") for error in json.loads(response.body).get("Errors") or [])
+            raise TransactionConflictError("transaction rolled back: {}".format(errors))
+        raise TransactionError("transaction failed ({}): {}".format(response.code, errors))
+
+    def _apply(self, ops):
+        for op in ops:
+            if op["Verb"] == "set":
+                self.client.kv.put(op["Key"], base64.b64decode(op["Value"]))
+            elif op["Verb"] == "cas":
+                if not self.client.kv.put(op["Key"], base64.b64decode(op["Value"]), cas=op["Index"]):
+                    raise TransactionConflictError("{} changed since it was read".format(op["Key"]))
+            elif op["Verb"] == "delete-cas":
+                if not self.client.kv.delete(op["Key"], cas=op["Index"]):
+                    raise TransactionConflictError("{} changed since it was read".format(op["Key"]))
+            else:
+                self.client.kv.delete(op["Key"], recurse=op["Verb"] == "delete-tree" or None)
+
+    def _put(self, key, value):
+        txn = getattr(self.local, "txn", None)
+        if txn is None:
+            return self.client.kv.put(key, value)
+        txn.put(key, value)
+
+    def _delete(self, key, recurse=None, cas=None):
+        txn = getattr(self.local, "txn", None)
+        if txn is None:
+            return self.client.kv.delete(key, recurse=recurse, cas=cas)
+        txn.delete(key, recurse, cas)
 
     def generate_token(self, instance_name):
         rules = ACL_TEMPLATE.format(service_name=self.service_name,
@@ -62,20 +248,41 @@ class ConsulManager(object):
         _, instances = self.client.health.service("nginx", tag=self.service_name)
         return instances
 
+    def watch_service_health(self, index=None, wait=None):
+        """
+        Blocking query on the health of the nginx service, returning the new
+        index and the instances once they change past ``index`` or ``wait``
+        expires.
+        """
+        return self.client.health.service("nginx", index=index, wait=wait, tag=self.service_name)
+
+    def watch_critical_checks(self, index=None, wait=None):
+        """
+        Blocking query on the checks in critical state, returning the new
+        index and the checks once they change past ``index`` or ``wait``
+        expires.
+        """
+        return self.client.health.state("critical", index=index, wait=wait)
+
     def list_node(self):
         _, nodes = self.client.catalog.nodes()
         return nodes
 
     def remove_node(self, instance_name, server_name, host_id):
-        self.client.kv.delete(self._server_status_key(instance_name, server_name))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "", host_id), recurse=True)
+        with self.transaction():
+            self.remove_node_keys(instance_name, server_name, host_id)
+        self.leave_node(server_name)
+
+    def remove_node_keys(self, instance_name, server_name, host_id):
+        self._delete(self._server_status_key(instance_name, server_name))
+        self._delete(self._ssl_cert_path(instance_name, "", host_id), recurse=True)
+
+    def leave_node(self, server_name):
         self.client.agent.force_leave(server_name)
+        self.node_index.discard(server_name)
 
     def node_hostname(self, host):
-        for node in self.list_node():
-            if node['Address'] == host:
-                return node['Node']
-        return None
+        return self.node_index.get(self.client, host, self.node_index_ttl)
 
     def node_status(self, instance_name):
         node_status = self.client.kv.get(self._server_status_key(instance_name), recurse=True)
@@ -87,6 +294,17 @@ class ConsulManager(object):
         return node_status_list
 
     def write_location(self, instance_name, path, destination=None, content=None, router_mode=False, bind_mode=False):
+        for attempt in xrange(self.cas_retries + 1):
+            try:
+                with self.transaction():
+                    self._write_location(instance_name, path, destination, content, router_mode, bind_mode)
+                return
+            except TransactionConflictError:
+                if attempt == self.cas_retries:
+                    raise
+                self._cas_backoff(attempt)
+
+    def _write_location(self, instance_name, path, destination, content, router_mode, bind_mode):
         if content:
             content = content.strip()
         else:
@@ -98,7 +316,7 @@ class ConsulManager(object):
             if router_mode:
                 upstream_server = None
             self.add_server_upstream(instance_name, upstream, upstream_server)
-        self.client.kv.put(self._location_key(instance_name, path), content)
+        self._put(self._location_key(instance_name, path), content)
 
     def remove_location(self, instance_name, path):
         self.client.kv.delete(self._location_key(instance_name, path))
@@ -166,62 +384,122 @@ class ConsulManager(object):
     def add_server_upstream(self, instance_name, upstream_name, server):
         if not server:
             return
-        servers = self.list_upstream(instance_name, upstream_name)
         if isinstance(server, list):
             for idx, _ in enumerate(server):
                 server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers |= set(server)
+            new_servers = set(server)
         else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            servers.add(server)
-        self._save_upstream(instance_name, upstream_name, servers)
+            new_servers = set([":".join(map(str, filter(None, host_from_destination(server))))])
+        if self.upstream_layout == "keys":
+            with self.transaction():
+                self._migrate_upstream(instance_name, upstream_name)
+                for new_server in new_servers:
+                    self._put(self._upstream_server_key(instance_name, upstream_name, new_server), new_server)
+            return
+        self._update_upstream(instance_name, upstream_name, lambda servers: servers | new_servers)
 
     def remove_server_upstream(self, instance_name, upstream_name, server):
-        servers = self.list_upstream(instance_name, upstream_name)
         if isinstance(server, list):
             for idx, _ in enumerate(server):
                 server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers -= set(server)
-        else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            if server in servers:
-                servers.remove(server)
-        if len(servers) < 1:
-            self._remove_upstream(instance_name, upstream_name)
+            old_servers = set(server)
         else:
-            self._save_upstream(instance_name, upstream_name, servers)
-
-    def _remove_upstream(self, instance_name, upstream_name):
-        content = self._set_header_footer(None, "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+            old_servers = set([":".join(map(str, filter(None, host_from_destination(server))))])
+        if self.upstream_layout == "keys":
+            with self.transaction():
+                self._migrate_upstream(instance_name, upstream_name)
+                for old_server in old_servers:
+                    self._delete(self._upstream_server_key(instance_name, upstream_name, old_server))
+            return
+        self._update_upstream(instance_name, upstream_name, lambda servers: servers - old_servers)
+
+    def _update_upstream(self, instance_name, upstream_name, update):
+        """
+        Read-modify-write of an upstream guarded by the key ModifyIndex,
+        retried with jittered backoff when a concurrent writer wins.
+        """
+        key = self._upstream_key(instance_name, upstream_name)
+        txn = getattr(self.local, "txn", None)
+        for attempt in xrange(self.cas_retries + 1):
+            cas_stats.incr("attempts")
+            _, item = self.client.kv.get(key)
+            servers = self._upstream_servers(item)
+            new_servers = update(servers)
+            if item and new_servers == servers:
+                return
+            content = self._upstream_content(new_servers)
+            index = item["ModifyIndex"] if item else 0
+            if txn is not None:
+                txn.put(key, content, cas=index)
+                return
+            if self.client.kv.put(key, content, cas=index):
+                return
+            cas_stats.incr("conflicts")
+            self._cas_backoff(attempt)
+        cas_stats.incr("exhausted")
+        logging.warning("giving up updating upstream %s after %d conflicts", key, self.cas_retries + 1)
+        raise UpstreamConflictError("upstream {} is being concurrently updated".format(upstream_name))
+
+    def _cas_backoff(self, attempt):
+        time.sleep(random.uniform(0, self.cas_backoff * (2 ** attempt)))
 
     def list_upstream(self, instance_name, upstream_name):
-        servers = self.client.kv.get(self._upstream_key(instance_name, upstream_name))[1]
-        if servers:
-            servers = self._set_header_footer(servers["Value"], "upstream", True)
+        servers = self._upstream_servers(self.client.kv.get(self._upstream_key(instance_name, upstream_name))[1])
+        if self.upstream_layout == "keys":
+            prefix = self._upstream_server_key(instance_name, upstream_name, "")
+            keys = self.client.kv.get(prefix, keys=True)[1] or []
+            servers |= set(key[len(prefix):] for key in keys)
+        return servers
+
+    def migrate_upstreams(self, instance_name):
+        """
+        Moves every upstream of the instance still stored as a single
+        comma-separated value to one key per server.
+        """
+        items = self.client.kv.get(self._upstream_key(instance_name, ""), recurse=True)[1] or []
+        migrated = []
+        with self.transaction():
+            for item in items:
+                upstream_name = item["Key"].split("/")[-1]
+                if upstream_name and self._migrate_upstream(instance_name, upstream_name, item):
+                    migrated.append(upstream_name)
+        return migrated
+
+    def _migrate_upstream(self, instance_name, upstream_name, item=None):
+        key = self._upstream_key(instance_name, upstream_name)
+        if item is None:
+            item = self.client.kv.get(key)[1]
+        if item is None:
+            return False
+        for server in self._upstream_servers(item):
+            self._put(self._upstream_server_key(instance_name, upstream_name, server), server)
+        self._delete(key, cas=item["ModifyIndex"])
+        return True
+
+    def _upstream_servers(self, item):
+        if item:
+            servers = self._set_header_footer(item["Value"], "upstream", True)
             if servers == "":
                 return set()
             return set(servers.split(","))
         return set()
 
-    def _save_upstream(self, instance_name, upstream_name, servers):
-        content = self._set_header_footer(",".join(servers), "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+    def _upstream_content(self, servers):
+        if not servers:
+            return self._set_header_footer(None, "upstream")
+        return self._set_header_footer(",".join(servers), "upstream")
 
     def swap_instances(self, src_instance, dst_instance):
         if not self.check_swap_state(src_instance, dst_instance):
             raise InstanceAlreadySwappedError()
         src_instance_value = self.client.kv.get(self._key(src_instance, "swap"))[1]
-        if not src_instance_value:
-            self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-            self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
-            return
-        if src_instance_value['Value'] == dst_instance:
-            self.client.kv.delete(self._key(src_instance, "swap"))
-            self.client.kv.delete(self._key(dst_instance, "swap"))
-            return
-        self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-        self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
+        with self.transaction():
+            if src_instance_value and src_instance_value['Value'] == dst_instance:
+                self._delete(self._key(src_instance, "swap"))
+                self._delete(self._key(dst_instance, "swap"))
+                return
+            self._put(self._key(src_instance, "swap"), dst_instance)
+            self._put(self._key(dst_instance, "swap"), src_instance)
 
     def check_swap_state(self, src_instance, dst_instance):
         src_instance_status = self.client.kv.get(self._key(src_instance, "swap"))[1]
@@ -275,14 +553,16 @@ class ConsulManager(object):
         return cert["Value"], key["Value"]
 
     def set_certificate(self, instance_name, cert_data, key_data, host_id=None):
-        self.client.kv.put(self._ssl_cert_path(instance_name, "cert", host_id),
-                           cert_data.replace("\r\n", "\n"))
-        self.client.kv.put(self._ssl_cert_path(instance_name, "key", host_id),
-                           key_data.replace("\r\n", "\n"))
+        with self.transaction():
+            self._put(self._ssl_cert_path(instance_name, "cert", host_id),
+                      cert_data.replace("\r\n", "\n"))
+            self._put(self._ssl_cert_path(instance_name, "key", host_id),
+                      key_data.replace("\r\n", "\n"))
 
     def delete_certificate(self, instance_name):
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "cert"))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "key"))
+        with self.transaction():
+            self._delete(self._ssl_cert_path(instance_name, "cert"))
+            self._delete(self._ssl_cert_path(instance_name, "key"))
 
     def _ssl_cert_path(self, instance_name, key_type, host_id=None):
         if host_id:
@@ -320,6 +600,10 @@ class ConsulManager(object):
         base_key = "upstream/{}".format(upstream_name)
         return self._key(instance_name, base_key)
 
+    def _upstream_server_key(self, instance_name, upstream_name, server):
+        base_key = "upstream_servers/{}/{}".format(upstream_name, server)
+        return self._key(instance_name, base_key)
+
     def _acl_key(self, instance_name, src=None):
         base_key = "acl"
         if src:
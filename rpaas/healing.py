@@ -2,9 +2,12 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
 import os
+import threading
 import time
-from rpaas import scheduler, tasks
+from rpaas import consul_manager, scheduler, tasks
+from rpaas.misc import check_option_enable
 
 
 class RestoreMachine(scheduler.JobScheduler):
@@ -32,6 +35,10 @@ class CheckMachine(scheduler.JobScheduler):
     CheckMachine detects machines where checks as marked 'critical' on
     Consul and creates tasks to be consumed by RestoreMachine.
 
+    With CHECK_MACHINE_WATCH enabled, it also keeps blocking queries open on
+    the nginx service health and on the critical checks, and runs the check
+    as soon as either of them changes. The check still runs every interval,
+    so machines are checked again when a check or a watch fails.
     """
 
     def __init__(self, config=None, *args, **kwargs):
@@ -39,10 +46,63 @@ class CheckMachine(scheduler.JobScheduler):
         self.config = config or dict(os.environ)
         self.interval = int(self.config.get("CHECK_MACHINE_RUN_INTERVAL", 30))
         self.last_run_key = self.get_last_run_key("CHECK_MACHINE")
+        self.watch = check_option_enable(self.config.get("CHECK_MACHINE_WATCH"))
+        self.watch_wait = self.config.get("CHECK_MACHINE_WATCH_WAIT", "5m")
+        self.watch_retry_interval = int(self.config.get("CHECK_MACHINE_WATCH_RETRY_INTERVAL", 5))
+        self.indexes = {}
+        self.changed = threading.Event()
 
     def run(self):
         self.running = True
+        if self.watch:
+            self.run_watch()
+            return
         while self.running:
             if self.try_lock():
                 tasks.CheckMachineTask().delay(self.config)
             time.sleep(self.interval / 2)
+
+    def run_watch(self):
+        manager = consul_manager.ConsulManager(self.config)
+        queries = {"service": manager.watch_service_health, "critical": manager.watch_critical_checks}
+        self.indexes = dict.fromkeys(queries)
+        for name, query in queries.items():
+            watcher = threading.Thread(target=self.watch_query, args=(name, query))
+            watcher.daemon = True
+            watcher.start()
+        last_lock = 0
+        while self.running:
+            if self.changed.wait(1):
+                self.changed.clear()
+                if self.try_lock_indexes():
+                    tasks.CheckMachineTask().delay(self.config)
+            if time.time() - last_lock >= self.interval / 2:
+                last_lock = time.time()
+                if self.try_lock():
+                    tasks.CheckMachineTask().delay(self.config)
+
+    def watch_query(self, name, query):
+        index = None
+        while self.running:
+            try:
+                new_index, _ = query(index=index, wait=self.watch_wait)
+            except Exception as e:
+                logging.error("check_machine: error watching {} health: {}".format(name, e))
+                time.sleep(self.watch_retry_interval)
+                continue
+            # a lower index means consul state was reset, the query must
+            # start over instead of blocking until the old index is reached
+            if index is not None and int(new_index) < int(index):
+                new_index = None
+            if new_index != index:
+                self.indexes[name] = new_index
+                self.changed.set()
+            index = new_index
+
+    def try_lock_indexes(self):
+        """
+        Every API process watches the same indexes, only the first one to
+        see a given change runs the check.
+        """
+        key = "{}:{}".format(self.last_run_key, ":".join(str(index) for _, index in sorted(self.indexes.items())))
+        return bool(self.conn.set(key, "1", nx=True, ex=self.interval))
@@ -20,8 +20,10 @@ class Lock(object):
     def unlock(self, lock_name):
         position = self._find_lock_pos(lock_name)
         if position is not None:
-            self.redis_locks[position].release()
-            del self.redis_locks[position]
+            # removed before releasing, as the release round-trip may let a
+            # concurrent caller sharing this manager shift the positions
+            redis_lock = self.redis_locks.pop(position)
+            redis_lock.release()
 
     def extend_lock(self, lock_name, extra_time):
         position = self._find_lock_pos(lock_name)
@@ -6,19 +6,20 @@
 
 import copy
 import datetime
-import os
 import socket
 import threading
 import time
 
 import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
+from hm.config import get_config
 from hm.model.load_balancer import LoadBalancer
 from celery.utils import uuid
 
-from rpaas import (consul_manager, nginx, sslutils, ssl_plugins,
+from rpaas import (cache, consul_manager, nginx, sslutils, ssl_plugins,
                    storage, tasks, acl, lock)
-from rpaas.misc import check_option_enable, host_from_destination
+from rpaas.misc import (check_option_enable, host_from_destination, run_parallel,
+                        DeadlineExceededError)
 
 PENDING = "pending"
 FAILURE = "failure"
@@ -31,10 +32,14 @@ class Manager(object):
         self.storage = storage.MongoDBStorage(config)
         self.consul_manager = consul_manager.ConsulManager(config)
         self.nginx_manager = nginx.Nginx(config)
-        self.task_manager = tasks.TaskManager(config)
-        self.service_name = os.environ.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.task_manager = tasks.TaskManager(config, self.storage)
+        self.service_name = get_config("RPAAS_SERVICE_NAME", "rpaas", config)
+        self.lb_cache_ttl = int((config or {}).get("RPAAS_LB_CACHE_TTL", 5))
+        self.purge_concurrency = int((config or {}).get("RPAAS_PURGE_CONCURRENCY", 10))
+        self.purge_timeout = int((config or {}).get("RPAAS_PURGE_TIMEOUT", 10))
+        self.bulk_purge_timeout = int((config or {}).get("RPAAS_BULK_PURGE_TIMEOUT", 60))
         self.acl_manager = acl.Dumb(self.consul_manager)
-        if check_option_enable(os.environ.get("CHECK_ACL_API", None)):
+        if check_option_enable(get_config("CHECK_ACL_API", None, config)):
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(tasks.app.backend.client))
 
     def new_instance(self, name, team=None, plan_name=None, flavor_name=None):
@@ -44,23 +49,32 @@ class Manager(object):
             plan = self.storage.find_plan(plan_name)
         if flavor_name:
             flavor = self.storage.find_flavor(flavor_name)
-        used, quota = self.storage.find_team_quota(team)
-        if len(used) >= quota:
+        reserved, used, quota = self.storage.reserve_quota(team, name)
+        if not reserved:
             raise QuotaExceededError(len(used), quota)
-        if not self.storage.increment_quota(team, used, name):
-            raise Exception("concurrent operations updating team quota")
+        try:
+            self._create_instance(name, team, plan, flavor)
+        except:
+            if name not in used:
+                self.storage.decrement_quota(name, team)
+            raise
+
+    def _create_instance(self, name, team, plan, flavor):
         lb = LoadBalancer.find(name)
         if lb is not None:
             raise storage.DuplicateError(name)
         self.task_manager.create(name)
+        self.storage.bump_lb_stamp(name)
         config = copy.deepcopy(self.config)
         metadata = {}
+        if team:
+            metadata["team"] = team
         if plan:
             config.update(plan.config)
-            metadata["plan_name"] = plan_name
+            metadata["plan_name"] = plan.name
         if flavor:
             config.update(flavor.config)
-            metadata["flavor_name"] = flavor_name
+            metadata["flavor_name"] = flavor.name
         metadata["consul_token"] = consul_token = self.consul_manager.generate_token(name)
         self.consul_manager.write_healthcheck(name)
         self.storage.store_instance_metadata(name, **metadata)
@@ -94,10 +108,11 @@ class Manager(object):
                 config.update(flavor.config)
         if metadata and metadata.get("consul_token"):
             self.consul_manager.destroy_token(metadata["consul_token"])
-        self.storage.decrement_quota(name)
+        self.storage.decrement_quota(name, metadata.get("team") if metadata else None)
         self.storage.remove_task(name)
         self.storage.remove_binding(name)
         self.storage.remove_instance_metadata(name)
+        self.storage.bump_lb_stamp(name)
         tasks.RemoveInstanceTask().delay(config, name)
 
     def update_instance(self, name, plan_name=None, flavor_name=None):
@@ -106,7 +121,7 @@ class Manager(object):
         if flavor_name and not self.storage.find_flavor(flavor_name):
             raise storage.FlavorNotFoundError()
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         metadata = self.storage.find_instance_metadata(name)
@@ -117,21 +132,22 @@ class Manager(object):
         self.storage.store_instance_metadata(name, **metadata)
 
     def restore_machine_instance(self, name, machine, cancel_task=False):
-        task_name = "restore_{}".format(machine)
         if cancel_task:
-            self.task_manager.remove(task_name)
+            if not self.storage.cancel_restore(machine):
+                raise tasks.TaskNotFoundError("Task restore_{} not found for removal".format(machine))
             return
-        self.task_manager.ensure_ready(task_name)
-        lb = LoadBalancer.find(name)
+        restore = self.storage.find_restore(machine)
+        if restore is not None and restore['state'] != storage.RESTORE_DONE:
+            raise tasks.NotReadyError("Async task still running")
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         machine_data = self.storage.find_host_id(machine)
         if machine_data is None:
             raise InstanceMachineNotFoundError()
-        self.task_manager.create({"_id": task_name, "host": machine,
-                                 "instance": name, "created": datetime.datetime.utcnow()})
+        self.storage.sync_restores([(machine, name)], created=datetime.datetime.utcnow())
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
         self.task_manager.ensure_ready(name)
         self.task_manager.create(name)
         config = copy.deepcopy(self.config)
@@ -143,6 +159,7 @@ class Manager(object):
             flavor = self.storage.find_flavor(metadata["flavor_name"])
             config.update(flavor.config or {})
         healthcheck_timeout = int(config.get("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
         tags = []
         extra_tags = config.get("INSTANCE_EXTRA_TAGS", "")
         if extra_tags:
@@ -153,52 +170,85 @@ class Manager(object):
             lb = LoadBalancer.find(name, config)
             if lb is None:
                 raise storage.InstanceNotFoundError()
-            length = len(lb.hosts)
-            for idx, host in enumerate(lb.hosts):
-                yield "Restoring host ({}/{}) {} ".format(idx + 1, length, host.id)
-                stop_host_job = JobWaiting(host.stop, 0)
-                stop_host_job.start()
-                while stop_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(stop_host_job.result, Exception):
-                    raise stop_host_job.result
-                scale_host_job = JobWaiting(host.scale, 0)
-                scale_host_job.start()
-                while scale_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(scale_host_job.result, Exception):
-                    raise scale_host_job.result
-                restore_host_job = JobWaiting(host.restore, 0, reset_template=True, reset_tags=True)
+            hosts = list(lb.hosts)
+            window = self._restore_window(max_unavailable or config.get("RPAAS_RESTORE_MAX_UNAVAILABLE", 1),
+                                          len(hosts))
+            if window > 1:
+                for msg in self._rolling_restore(hosts, window, healthcheck_timeout, restore_delay):
+                    yield msg
+                return
+            for idx, host in enumerate(hosts):
+                yield "Restoring host ({}/{}) {} ".format(idx + 1, len(hosts), host.id)
+                restore_host_job = JobWaiting(self._restore_host, 0, host=host,
+                                              healthcheck_timeout=healthcheck_timeout,
+                                              restore_delay=restore_delay)
                 restore_host_job.start()
                 while restore_host_job.is_alive():
                     yield "."
                     time.sleep(1)
                 if isinstance(restore_host_job.result, Exception):
                     raise restore_host_job.result
-                host.start()
-                nginx_waiting = self.nginx_manager.wait_healthcheck
-                restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
-                nginx_healthcheck_job = JobWaiting(nginx_waiting, restore_delay, host=host.dns_name,
-                                                   timeout=healthcheck_timeout, manage_healthcheck=False)
-                nginx_healthcheck_job.start()
-                while nginx_healthcheck_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(nginx_healthcheck_job.result, Exception):
-                    raise nginx_healthcheck_job.result
                 yield ": successfully restored\n"
         except storage.InstanceNotFoundError:
             yield "instance {} not found\n".format(name)
         except Exception as e:
             yield ": failed to restore - {}\n".format(repr(e.message))
         finally:
+            self.storage.bump_lb_stamp(name)
             self.task_manager.remove(name)
 
+    def _restore_window(self, max_unavailable, total):
+        """
+        Number of hosts restored at the same time: a host count or a
+        percentage of the instance hosts, always leaving one host serving.
+        """
+        value, percentage = parse_max_unavailable(max_unavailable)
+        window = total * value // 100 if percentage else value
+        return max(min(window, total - 1), 1)
+
+    def _restore_host(self, host, healthcheck_timeout, restore_delay):
+        host.stop()
+        host.scale()
+        host.restore(reset_template=True, reset_tags=True)
+        host.start()
+        self.nginx_manager.wait_healthcheck(host=host.dns_name, timeout=healthcheck_timeout,
+                                            manage_healthcheck=False)
+        time.sleep(restore_delay)
+
+    def _rolling_restore(self, hosts, window, healthcheck_timeout, restore_delay):
+        """
+        Restores up to ``window`` hosts at once, starting the next host as
+        soon as one is back. After a failure no other host is started.
+        """
+        pending = list(enumerate(hosts, 1))
+        running = []
+        failed = False
+        while running or (pending and not failed):
+            while pending and not failed and len(running) < window:
+                idx, host = pending.pop(0)
+                job = JobWaiting(self._restore_host, 0, host=host, healthcheck_timeout=healthcheck_timeout,
+                                 restore_delay=restore_delay)
+                job.start()
+                running.append((host, job))
+                yield "Restoring host ({}/{}) {}\n".format(idx, len(hosts), host.id)
+            finished = [entry for entry in running if not entry[1].is_alive()]
+            if not finished:
+                yield "."
+                time.sleep(1)
+                continue
+            for host, job in finished:
+                running.remove((host, job))
+                if isinstance(job.result, Exception):
+                    failed = True
+                    yield "host {}: failed to restore - {}\n".format(host.id, repr(job.result.message))
+                else:
+                    yield "host {}: successfully restored\n".format(host.id)
+        if pending:
+            yield "restore stopped, {} hosts not restored\n".format(len(pending))
+
     def bind(self, name, app_host, router_mode=False):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         binding_data = self.storage.find_binding(name)
@@ -216,7 +266,7 @@ class Manager(object):
 
     def unbind(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         binding_data = self.storage.find_binding(name)
@@ -241,7 +291,7 @@ class Manager(object):
                     routes_data.append("destination = {}".format(dst))
                 if content:
                     routes_data.append("content = {}".format(content))
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         host_count = 0
         if lb:
             host_count = len(lb.hosts)
@@ -271,13 +321,13 @@ class Manager(object):
         self.task_manager.ensure_ready(src_instance)
         self.task_manager.ensure_ready(dst_instance)
         for instance in [src_instance, dst_instance]:
-            lb = LoadBalancer.find(instance)
+            lb = self._find_lb(instance)
             if lb is None:
                 raise storage.InstanceNotFoundError(instance)
         self.consul_manager.swap_instances(src_instance, dst_instance)
 
     def node_status(self, name):
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         hostnames = {}
@@ -294,28 +344,28 @@ class Manager(object):
 
     def get_certificate(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.get_certificate(name)
 
     def update_certificate(self, name, cert, key):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.set_certificate(name, cert, key)
 
     def delete_certificate(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.delete_certificate(name)
 
     def add_upstream(self, name, upstream_name, servers, acl=False):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         if acl:
@@ -329,18 +379,33 @@ class Manager(object):
 
     def remove_upstream(self, name, upstream_name, servers):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_server_upstream(name, upstream_name, servers)
 
     def list_upstreams(self, name, upstream_name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_upstream(name, upstream_name)
 
+    def migrate_upstreams(self, name):
+        lb = self._find_lb(name)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        return self.consul_manager.migrate_upstreams(name)
+
+    def _find_lb(self, name):
+        stamp = self.storage.find_lb_stamp(name)
+        lb = cache.load_balancers.get(name, self.lb_cache_ttl, stamp)
+        if lb is None:
+            lb = LoadBalancer.find(name)
+            if lb is not None:
+                cache.load_balancers.set(name, lb, stamp)
+        return lb
+
     def _get_address(self, name):
         task = self.storage.find_task(name)
         if task.count() >= 1:
@@ -348,7 +413,7 @@ class Manager(object):
             if result.status in ["FAILURE", "REVOKED"]:
                 return FAILURE
             return PENDING
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return lb.address
@@ -377,7 +442,7 @@ class Manager(object):
     def add_route(self, name, path, destination, content):
         self.task_manager.ensure_ready(name)
         path = path.strip()
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.storage.replace_binding_path(name, path, destination, content)
@@ -389,24 +454,12 @@ class Manager(object):
         path = path.strip()
         if path == "/":
             raise RouteError("You cannot remove a route for / location, unbind the app.")
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
-        routes = self.list_routes(name)
-        destination_count = 0
-        if not routes:
-            raise storage.InstanceNotFoundError()
-        destination = [p['destination'] for p in routes['paths'] if p['path'] == path]
-        if len(destination) > 0:
-            destination = destination.pop()
-        else:
-            destination = None
-        for p in routes['paths']:
-            if destination and p['destination'] == destination:
-                destination_count += 1
-        if destination_count == 1:
+        destination, references = self.storage.delete_binding_path(name, path)
+        if destination and references == 0:
             self.consul_manager.remove_server_upstream(name, destination, destination)
-        self.storage.delete_binding_path(name, path)
         self.consul_manager.remove_location(name, path)
 
     def list_routes(self, name):
@@ -419,19 +472,55 @@ class Manager(object):
         self.task_manager.ensure_ready(name)
         if not preserve_path:
             path = path.strip()
-        lb = LoadBalancer.find(name)
-        purged_hosts = 0
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            if self.nginx_manager.purge_location(host.dns_name, path, preserve_path):
-                purged_hosts += 1
-        return purged_hosts
+        variants = self.nginx_manager.purge_variants(path, preserve_path)
+        jobs = [(host.dns_name, variant) for host in lb.hosts for variant in variants]
+        results = dict((host.dns_name, {}) for host in lb.hosts)
+        purged = run_parallel(lambda job: self.nginx_manager.purge_variant(*job), jobs,
+                              self.purge_concurrency, self.purge_timeout)
+        for (host, variant), result in purged:
+            results[host][variant[0]] = self._purge_status(result)
+        return results
+
+    def purge_locations(self, name, paths, preserve_path=False):
+        self.task_manager.ensure_ready(name)
+        unique_paths = []
+        for path in paths:
+            if not preserve_path:
+                path = path.strip()
+            if path and path not in unique_paths:
+                unique_paths.append(path)
+        lb = self._find_lb(name)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        jobs = [(unique_path, variant) for unique_path in unique_paths
+                for variant in self.nginx_manager.purge_variants(unique_path, preserve_path)]
+        deadline = time.time() + self.bulk_purge_timeout
+        variants = [variant for _, variant in jobs]
+        purged = run_parallel(lambda host: self.nginx_manager.purge_batch(host, variants, deadline),
+                              [host.dns_name for host in lb.hosts],
+                              self.purge_concurrency, self.bulk_purge_timeout)
+        results = dict((path, {}) for path in unique_paths)
+        for host, host_results in purged:
+            if not isinstance(host_results, list):
+                host_results = [host_results] * len(jobs)
+            for (path, variant), result in zip(jobs, host_results):
+                results[path].setdefault(host, {})[variant[0]] = self._purge_status(result)
+        return results
+
+    def _purge_status(self, result):
+        if result is None or isinstance(result, DeadlineExceededError):
+            return "timeout"
+        if result is True:
+            return "purged"
+        return "not purged"
 
     def add_block(self, name, block_name, content):
         self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.write_block(name, block_name, content)
@@ -439,35 +528,35 @@ class Manager(object):
     def delete_block(self, name, block_name):
         self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_block(name, block_name)
 
     def list_blocks(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_blocks(name)
 
     def add_lua(self, name, lua_module_name, lua_module_type, content):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             storage.InstanceNotFoundError()
         self.consul_manager.write_lua(name, lua_module_name, lua_module_type, content)
 
     def list_lua(self, name):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         return self.consul_manager.list_lua_modules(name)
 
     def delete_lua(self, name, lua_module_name, lua_module_type):
         self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
         self.consul_manager.remove_lua(name, lua_module_name, lua_module_type)
@@ -496,7 +585,7 @@ class Manager(object):
         return True
 
     def activate_ssl(self, name, domain, plugin='default'):
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
 
@@ -522,7 +611,7 @@ class Manager(object):
             return ''
 
     def revoke_ssl(self, name, plugin='default'):
-        lb = LoadBalancer.find(name)
+        lb = self._find_lb(name)
         if lb is None:
             raise storage.InstanceNotFoundError()
 
@@ -561,6 +650,22 @@ class JobWaiting(threading.Thread):
             self.result = e
 
 
+def parse_max_unavailable(max_unavailable):
+    """
+    Parses the number of hosts restore_instance may restore at once, given
+    as a positive integer or as a percentage between 1% and 100%. Returns
+    the number along with whether it is a percentage, raising ValueError for
+    anything else.
+    """
+    value = str(max_unavailable).strip()
+    percentage = value.endswith("%")
+    if percentage:
+        value = value[:-1]
+    if not value.isdigit() or int(value) < 1 or (percentage and int(value) > 100):
+        raise ValueError("max_unavailable must be a positive integer or a percentage between 1% and 100%")
+    return int(value), percentage
+
+
 class BindError(Exception):
     pass
 
@@ -3,7 +3,10 @@
 # license that can be found in the LICENSE file.
 
 import os
+import Queue
 import re
+import threading
+import time
 import urlparse
 
 
@@ -11,6 +14,10 @@ class ValidationError(Exception):
     pass
 
 
+class DeadlineExceededError(Exception):
+    pass
+
+
 def check_option_enable(option):
     if option is not None and str(option) in ('True', 'true', '1'):
         return True
@@ -31,3 +38,118 @@ def host_from_destination(destination):
     if '//' not in destination:
         destination = '%s%s' % ('http://', destination)
     return urlparse.urlparse(destination).hostname, urlparse.urlparse(destination).port
+
+
+class ProcessCache(object):
+    """
+    ProcessCache keeps long-lived objects (database clients, HTTP sessions)
+    shared by every caller in the current process.
+
+    Objects are built by ``factory`` on first use for each key. Entries
+    created before a fork are discarded on the child's first access, since
+    sockets must not be shared between processes.
+    """
+
+    def __init__(self, factory, close=None):
+        self.factory = factory
+        self.close = close
+        self.pid = os.getpid()
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, *key):
+        self._check_pid()
+        item = self.items.get(key)
+        if item is None:
+            with self.lock:
+                item = self.items.get(key)
+                if item is None:
+                    item = self.items[key] = self.factory(*key)
+        return item
+
+    def clear(self):
+        with self.lock:
+            items = self.items.values()
+            self.items = {}
+        if self.close is None:
+            return
+        for item in items:
+            try:
+                self.close(item)
+            except Exception:
+                pass
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid != self.pid:
+            # the lock may have been copied while held by a parent thread
+            self.lock = threading.Lock()
+            self.items = {}
+            self.pid = pid
+
+
+def iter_parallel(func, items, max_workers, timeout=None):
+    """
+    Calls ``func`` for every item using at most ``max_workers`` threads and
+    yields ``(item, result)`` pairs as each call finishes. ``result`` is
+    whatever ``func`` returned, or the exception it raised.
+
+    When ``timeout`` seconds pass before every call finishes, the remaining
+    items are yielded with a DeadlineExceededError and calls not started yet
+    are skipped. Calls already running are left to finish in background.
+    """
+    items = list(items)
+    if not items:
+        return
+    pending = Queue.Queue()
+    for idx in range(len(items)):
+        pending.put(idx)
+    finished = Queue.Queue()
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            try:
+                idx = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = func(items[idx])
+            except Exception as e:
+                result = e
+            finished.put((idx, result))
+
+    for _ in range(min(max(int(max_workers), 1), len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+    done = set()
+    while len(done) < len(items):
+        try:
+            if deadline is None:
+                idx, result = finished.get()
+            else:
+                idx, result = finished.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
+        done.add(idx)
+        yield items[idx], result
+    cancelled.set()
+    for idx, item in enumerate(items):
+        if idx not in done:
+            yield item, DeadlineExceededError("deadline of {}s exceeded".format(timeout))
+
+
+def run_parallel(func, items, max_workers, timeout=None):
+    """
+    Same as iter_parallel, but returns every ``(item, result)`` pair at
+    once, in the order of ``items``.
+    """
+    indexed = list(enumerate(items))
+    results = [None] * len(indexed)
+    for (idx, item), result in iter_parallel(lambda pair: func(pair[1]), indexed, max_workers, timeout):
+        results[idx] = (item, result)
+    return results
@@ -3,13 +3,21 @@
 # license that can be found in the LICENSE file.
 
 import time
-import datetime
+import logging
 import os
+import random
+import re
+import string
+import sys
+import threading
 
 import requests
+from requests import exceptions as requests_exceptions
 
 from hm import config
 
+from rpaas.misc import iter_parallel
+
 NGINX_LOCATION_INSTANCE_NOT_BOUND = '''
 location / {
     return 404 "Instance not bound";
@@ -43,8 +51,99 @@ location {path} {{
 '''
 
 
+FIELD_NAME = re.compile(r"^[A-Za-z_]\w*$")
+
+
 class NginxError(Exception):
-    pass
+
+    def __init__(self, message, status_code=None):
+        super(NginxError, self).__init__(message)
+        self.status_code = status_code
+
+
+class RetryStats(object):
+    """
+    Calls, attempts, failures and accumulated latency of the retried
+    requests, by call site, reported by stats().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def record(self, name, attempts, latency, failed):
+        with self.lock:
+            site = self.sites.setdefault(name, {"calls": 0, "attempts": 0, "failures": 0, "latency": 0.0})
+            site["calls"] += 1
+            site["attempts"] += attempts
+            site["latency"] += latency
+            if failed:
+                site["failures"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.sites = {}
+
+    def stats(self):
+        with self.lock:
+            return dict((name, dict(site)) for name, site in self.sites.items())
+
+
+retry_stats = RetryStats()
+
+
+class RetryPolicy(object):
+    """
+    RetryPolicy retries a call until it succeeds, fails with an error that
+    is not worth retrying, or the deadline passes. Only connection errors,
+    timeouts and transient nginx statuses are retried.
+
+    Waits between attempts grow exponentially from ``initial_delay`` up to
+    ``max_delay``, each one randomly shortened by up to half to spread the
+    retries of concurrent callers.
+    """
+
+    # client errors that may go away while nginx is still starting up
+    retryable_statuses = (404, 408, 429)
+
+    def __init__(self, initial_delay=0.5, max_delay=5, multiplier=2):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return random.uniform(delay / 2.0, delay)
+
+    def retryable(self, error):
+        if isinstance(error, requests_exceptions.SSLError):
+            return False
+        if isinstance(error, (requests_exceptions.ConnectionError, requests_exceptions.Timeout)):
+            return True
+        if not isinstance(error, NginxError) or error.status_code is None:
+            return False
+        return error.status_code >= 500 or error.status_code < 400 or \
+            error.status_code in self.retryable_statuses
+
+    def call(self, site, max_time, func, *args, **kwargs):
+        start = time.time()
+        deadline = start + max_time
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                now = time.time()
+                if now >= deadline or not self.retryable(sys.exc_info()[1]):
+                    retry_stats.record(site, attempt, now - start, True)
+                    if attempt > 1:
+                        logging.warning("%s failed after %d attempts in %.1fs", site, attempt, now - start)
+                    raise
+                time.sleep(min(self.delay(attempt - 1), deadline - now))
+            else:
+                retry_stats.record(site, attempt, time.time() - start, False)
+                return result
 
 
 def retry_request(f):
@@ -52,54 +151,149 @@ def retry_request(f):
         timeout = kwargs.get("timeout")
         if not timeout:
             timeout = 30
-        t0 = datetime.datetime.now()
-        timeout = datetime.timedelta(seconds=timeout)
-        while True:
-            try:
-                f(self, *args, **kwargs)
-                break
-            except:
-                now = datetime.datetime.now()
-            if now > t0 + timeout:
-                raise
-            time.sleep(1)
+        return self.retry_policy.call(f.__name__, timeout, f, self, *args, **kwargs)
     return f_retry
 
 
+class LocationTemplate(object):
+    """
+    LocationTemplate is a location template parsed once, so rendering only
+    joins the literal chunks with the given values.
+
+    Templates using anything beyond plain named fields (indexing, attribute
+    access, conversions or format specs) are rendered with str.format.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.chunks = []
+        self.simple = True
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if field is not None and (spec or conversion or not FIELD_NAME.match(field)):
+                self.simple = False
+            self.chunks.append((literal, field))
+
+    def format(self, **values):
+        if not self.simple:
+            return self.text.format(**values)
+        parts = []
+        for literal, field in self.chunks:
+            parts.append(literal)
+            if field is not None:
+                parts.append(format(values[field], ''))
+        return "".join(parts)
+
+
+class TemplateCache(object):
+    """
+    TemplateCache keeps location templates downloaded from
+    NGINX_LOCATION_TEMPLATE_*_URL shared by the whole process.
+
+    Only the first load of an URL blocks. Afterwards, expired entries are
+    still served while a background thread revalidates them with
+    If-None-Match/If-Modified-Since, and a failed revalidation keeps the
+    stale template until the next attempt.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, ttl, timeout):
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self._fetch(url, timeout)
+            self.entries[url] = entry
+            return entry["template"]
+        if time.time() - entry["fetched_at"] > ttl:
+            with self.lock:
+                refresh = not entry["refreshing"]
+                entry["refreshing"] = True
+            if refresh:
+                t = threading.Thread(target=self._revalidate, args=(url, entry, timeout))
+                t.daemon = True
+                t.start()
+        return entry["template"]
+
+    def clear(self):
+        self.entries = {}
+
+    def _fetch(self, url, timeout, entry=None):
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        rsp = requests.get(url, headers=headers, timeout=timeout)
+        if entry is not None and rsp.status_code == 304:
+            return dict(entry, fetched_at=time.time(), refreshing=False)
+        if rsp.status_code > 299:
+            raise NginxError("Error trying to load location template: {} - {}".
+                             format(rsp.status_code, rsp.text))
+        return {"template": LocationTemplate(rsp.text),
+                "etag": rsp.headers.get("ETag"),
+                "last_modified": rsp.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "refreshing": False}
+
+    def _revalidate(self, url, entry, timeout):
+        try:
+            self.entries[url] = self._fetch(url, timeout, entry)
+        except Exception as e:
+            logging.error("Error revalidating location template {}: {}".format(url, e))
+            self.entries[url] = dict(entry, fetched_at=time.time(), refreshing=False)
+
+
+location_templates = TemplateCache()
+
+default_location_templates = {
+    "DEFAULT": LocationTemplate(NGINX_LOCATION_TEMPLATE_DEFAULT),
+    "ROUTER": LocationTemplate(NGINX_LOCATION_TEMPLATE_ROUTER),
+}
+
+
 class ConfigManager(object):
 
     def __init__(self, conf=None):
-        self.location_template_default = self._load_location_template(conf, "default")
-        self.location_template_router = self._load_location_template(conf, "router")
+        self.template_cache_ttl = int(config.get_config('NGINX_LOCATION_TEMPLATE_CACHE_TTL', 300, conf))
+        self.template_timeout = int(config.get_config('NGINX_LOCATION_TEMPLATE_TIMEOUT', 10, conf))
+        self.template_sources = {}
+        for mode in ["default", "router"]:
+            self.template_sources[mode] = self._template_source(conf, mode)
+            self._load_location_template(mode)
+
+    @property
+    def location_template_default(self):
+        return self._load_location_template("default").text
+
+    @property
+    def location_template_router(self):
+        return self._load_location_template("router").text
 
     def generate_host_config(self, path, destination, upstream, router_mode=False):
-        if router_mode:
-            return self.location_template_router.format(
-                path=path.rstrip('/') + '/',
-                host=destination,
-                upstream=upstream
-            )
-        return self.location_template_default.format(
+        mode = "router" if router_mode else "default"
+        return self._load_location_template(mode).format(
             path=path.rstrip('/') + '/',
             host=destination,
             upstream=upstream
         )
 
-    def _load_location_template(self, conf, mode):
+    def _template_source(self, conf, mode):
         mode = mode.upper()
         template_txt = config.get_config('NGINX_LOCATION_TEMPLATE_{}_TXT'.format(mode), None, conf)
         if template_txt:
-            return template_txt
+            return LocationTemplate(template_txt)
         template_url = config.get_config('NGINX_LOCATION_TEMPLATE_{}_URL'.format(mode), None, conf)
         if template_url:
-            rsp = requests.get(template_url)
-            if rsp.status_code > 299:
-                raise NginxError("Error trying to load location template: {} - {}".
-                                 format(rsp.status_code, rsp.text))
-            return rsp.text
-        if mode == "DEFAULT":
-            return NGINX_LOCATION_TEMPLATE_DEFAULT
-        return NGINX_LOCATION_TEMPLATE_ROUTER
+            return template_url
+        return default_location_templates[mode]
+
+    def _load_location_template(self, mode):
+        source = self.template_sources[mode]
+        if isinstance(source, LocationTemplate):
+            return source
+        return location_templates.get(source, self.template_cache_ttl, self.template_timeout)
 
 
 class Nginx(object):
@@ -119,29 +313,65 @@ class Nginx(object):
                                                                 'WORKING', conf)
         self.ca_cert = config.get_config('CA_CERT', None, conf)
         self.ca_path = "/tmp/rpaas_ca.pem"
+        self.connect_timeout = float(config.get_config('NGINX_CONNECT_TIMEOUT', 2, conf))
+        self.read_timeout = float(config.get_config('NGINX_READ_TIMEOUT', 2, conf))
+        self.pool_hosts = int(config.get_config('NGINX_POOL_HOSTS', 100, conf))
+        self.pool_size = int(config.get_config('NGINX_POOL_SIZE', 10, conf))
+        self.healthcheck_concurrency = int(config.get_config('NGINX_HEALTHCHECK_CONCURRENCY', 50, conf))
+        self.retry_policy = RetryPolicy(float(config.get_config('NGINX_RETRY_INITIAL_DELAY', 0.5, conf)),
+                                        float(config.get_config('NGINX_RETRY_MAX_DELAY', 5, conf)))
+        self.session = None
+        self.session_pid = None
+        self.session_lock = threading.Lock()
         self.config_manager = ConfigManager(conf)
 
     def purge_location(self, host, path, preserve_path=False):
-        purge_path = self.nginx_purge_path.lstrip('/')
         purged = False
+        for variant in self.purge_variants(path, preserve_path):
+            if self.purge_variant(host, variant):
+                purged = True
+        return purged
+
+    def purge_variants(self, path, preserve_path=False):
+        """
+        Returns the cache key variants nginx must be asked to purge for
+        ``path`` as ``(name, purge path, headers)`` tuples.
+        """
+        purge_path = self.nginx_purge_path.lstrip('/')
+        variants = []
         if preserve_path:
             for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}".format(purge_path, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-            return purged
+                variants.append((encoding, "{}/{}".format(purge_path, path),
+                                 {'Accept-Encoding': encoding}))
+            return variants
         for scheme in ['http', 'https']:
             for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}{}".format(purge_path, scheme, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-        return purged
+                variants.append(("{}/{}".format(scheme, encoding),
+                                 "{}/{}{}".format(purge_path, scheme, path),
+                                 {'Accept-Encoding': encoding}))
+        return variants
+
+    def purge_variant(self, host, variant):
+        _, purge_path, headers = variant
+        try:
+            self._nginx_request(host, purge_path, headers)
+        except:
+            return False
+        return True
+
+    def purge_batch(self, host, variants, deadline=None):
+        """
+        Purges ``variants`` on ``host`` in sequence, over the pooled
+        keep-alive connections. Variants not attempted before ``deadline``
+        are reported as None.
+        """
+        results = []
+        for variant in variants:
+            if deadline is not None and time.time() >= deadline:
+                results.append(None)
+            else:
+                results.append(self.purge_variant(host, variant))
+        return results
 
     @retry_request
     def wait_healthcheck(self, host, timeout=30, manage_healthcheck=True):
@@ -155,6 +385,21 @@ class Nginx(object):
             port = self.nginx_app_port
         self._nginx_request(host, healthcheck_path, port=port, expected_response=expected_response)
 
+    def wait_healthcheck_many(self, hosts, timeout=30, manage_healthcheck=True):
+        """
+        Waits for the healthcheck of several hosts at once, yielding
+        ``(host, error)`` pairs as each host becomes healthy (error is None)
+        or gives up. Hosts still waiting when the deadline passes are
+        yielded last, with a DeadlineExceededError.
+        """
+        hosts = list(hosts)
+
+        def wait(host):
+            self.wait_healthcheck(host, timeout=timeout, manage_healthcheck=manage_healthcheck)
+
+        deadline = timeout + self.connect_timeout + self.read_timeout
+        return iter_parallel(wait, hosts, self.healthcheck_concurrency, deadline)
+
     @retry_request
     def add_session_ticket(self, host, data, timeout=30):
         self._nginx_request(host, 'session_ticket', data=data, method='POST', secure=True,
@@ -180,10 +425,29 @@ class Nginx(object):
             params['headers'] = headers
         if data:
             params['data'] = data
-        rsp = requests.request(method.lower(), url, timeout=2, **params)
+        rsp = self._session().request(method.lower(), url, timeout=(self.connect_timeout, self.read_timeout),
+                                      **params)
         if rsp.status_code != 200 or (expected_response and expected_response not in rsp.text):
             raise NginxError(
-                "Error trying to access admin path in nginx: {}: {}".format(url, rsp.text))
+                "Error trying to access admin path in nginx: {}: {}".format(url, rsp.text), rsp.status_code)
+
+    def _session(self):
+        """
+        Returns the session whose connection pools, one per nginx host, keep
+        admin connections (and their TLS sessions) alive between requests.
+        """
+        pid = os.getpid()
+        if self.session is None or self.session_pid != pid:
+            with self.session_lock:
+                if self.session is None or self.session_pid != pid:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_hosts,
+                                                            pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self.session = session
+                    self.session_pid = pid
+        return self.session
 
     def _ensure_ca_cert_file(self):
         if not self.ca_cert:
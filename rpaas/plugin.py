@@ -276,11 +276,14 @@ def lua(args):
 
 def purge(args):
     service, instance, path, preserve_path = get_purge_args(args)
-    req_path = "/resources/{}/purge".format(instance)
-    params = {}
     method = "POST"
-    params['path'] = path
-    params['preserve_path'] = preserve_path
+    if isinstance(path, list):
+        req_path = "/resources/{}/purge/bulk".format(instance)
+        params = [('path', p) for p in path]
+    else:
+        req_path = "/resources/{}/purge".format(instance)
+        params = [('path', path)]
+    params.append(('preserve_path', preserve_path))
     try:
         body = urllib.urlencode(params)
     except AttributeError:
@@ -468,21 +471,36 @@ def get_purge_args(args):
     parser = argparse.ArgumentParser("purge")
     parser.add_argument("-s", "--service", required=True, help="Service name")
     parser.add_argument("-i", "--instance", required=True, help="Instance name")
-    parser.add_argument("-l", "--location", required=True, help="Location to be purged")
+    locations = parser.add_mutually_exclusive_group(required=True)
+    locations.add_argument("-l", "--location", help="Location to be purged")
+    locations.add_argument("-f", "--file", help="File with one location to be purged per line, "
+                                                "all purged in a single request (- for stdin)")
     parser.add_argument("-p", "--preserve_path", required=False, action='store_true',
                         help="Use location as-is for cache key")
     parsed_args = parser.parse_args(args)
-    parsed_url = urlparse(parsed_args.location)
+    if parsed_args.file:
+        if parsed_args.file == "-":
+            lines = sys.stdin.readlines()
+        else:
+            with open(parsed_args.file) as f:
+                lines = f.readlines()
+        location = [purge_location_path(line.strip(), parsed_args.preserve_path)
+                    for line in lines if line.strip()]
+    else:
+        location = purge_location_path(parsed_args.location, parsed_args.preserve_path)
+    return parsed_args.service, parsed_args.instance, location, parsed_args.preserve_path
+
+
+def purge_location_path(location, preserve_path):
+    parsed_url = urlparse(location)
     if parsed_url.path == '':
         sys.stderr.write("purge: path is required for purge location\n")
         sys.exit(2)
+    if preserve_path:
+        return location
     if parsed_url.query == '':
-        location = parsed_url.path
-    else:
-        location = "{}?{}".format(parsed_url.path, parsed_url.query)
-    if parsed_args.preserve_path:
-        location = parsed_args.location
-    return parsed_args.service, parsed_args.instance, location, parsed_args.preserve_path
+        return parsed_url.path
+    return "{}?{}".format(parsed_url.path, parsed_url.query)
 
 
 def get_env(name):
@@ -121,6 +121,8 @@ def add_routes(name):
     try:
         m.bind(name, name, router_mode=True)
         m.add_upstream(name, name, addresses, True)
+    except consul_manager.UpstreamConflictError as e:
+        return str(e), 409
     except tasks.NotReadyError as e:
         return "Backend not ready: {}".format(e), 412
     except storage.InstanceNotFoundError:
@@ -144,6 +146,8 @@ def delete_routes(name):
         routes = m.list_upstreams(name, name)
         if len(routes) < 1:
             m.unbind(name)
+    except consul_manager.UpstreamConflictError as e:
+        return str(e), 409
     except tasks.NotReadyError as e:
         return "Backend not ready: {}".format(e), 412
     except storage.InstanceNotFoundError:
@@ -2,13 +2,32 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
 import datetime
 
+import bson
+import pymongo
 import pymongo.errors
 
-from hm import storage
+from hm import config, storage
 
 from rpaas import plan, flavor
+from rpaas.misc import ProcessCache
+
+clients = ProcessCache(pymongo.MongoClient, close=lambda client: client.close())
+
+# plans and flavors by (mongo uri, database, collection), stored along with
+# the change stamp they were loaded at
+catalogs = {}
+
+# (mongo uri, database, collection) whose indexes were already ensured by
+# this process
+indexed = set()
+
+# states of a machine restore in the restore queue
+RESTORE_PENDING = "pending"
+RESTORE_RUNNING = "running"
+RESTORE_DONE = "done"
 
 
 class InstanceNotFoundError(Exception):
@@ -37,6 +56,23 @@ class MongoDBStorage(storage.MongoDBStorage):
     quota_collection = "quota"
     le_certificates_collection = "le_certificates"
     healing_collection = "healing"
+    catalog_stamps_collection = "catalog_stamps"
+    lb_stamps_collection = "lb_stamps"
+    restore_queue_collection = "restore_queue"
+    default_quota = 5
+
+    def __init__(self, conf=None):
+        self.config = conf
+        self.mongo_uri = config.get_config('DBAAS_MONGODB_ENDPOINT', None, conf)
+        if not self.mongo_uri:
+            self.mongo_uri = config.get_config('MONGO_URI', 'mongodb://localhost:27017/', conf)
+        client = clients.get(self.mongo_uri)
+        try:
+            self.db = client.get_default_database()
+            self.mongo_database = self.db.name
+        except pymongo.errors.ConfigurationError:
+            self.mongo_database = config.get_config('MONGO_DATABASE', 'host_manager', conf)
+            self.db = client[self.mongo_database]
 
     def store_hc(self, hc):
         self.db[self.hcs_collections].update({"_id": hc["_id"]}, hc, upsert=True)
@@ -85,6 +121,177 @@ class MongoDBStorage(storage.MongoDBStorage):
         else:
             return self.db[self.tasks_collection].find({"_id": query})
 
+    def find_restore(self, host):
+        return self.db[self.restore_queue_collection].find_one({'_id': host})
+
+    def find_restore_states(self, hosts):
+        restores = self.db[self.restore_queue_collection].find({'_id': {'$in': list(hosts)}}, {'state': 1})
+        return dict((restore['_id'], restore['state']) for restore in restores)
+
+    def sync_restores(self, enqueue=None, cancel=None, created=None):
+        """
+        Queues the restore of every (host, instance) in enqueue not already
+        pending or running, and cancels the pending restores of the hosts in
+        cancel, in a single bulk write.
+        """
+        created = created or datetime.datetime.utcnow()
+        requests = []
+        for host, instance in enqueue or []:
+            restore = {'_id': host, 'host': host, 'instance': instance, 'state': RESTORE_PENDING,
+                       'created': created, 'next_attempt_at': created}
+            requests.append(pymongo.ReplaceOne({'_id': host, 'state': RESTORE_DONE}, restore, upsert=True))
+        if cancel:
+            requests.append(pymongo.DeleteMany({'_id': {'$in': list(cancel)}, 'state': RESTORE_PENDING}))
+        if not requests:
+            return
+        try:
+            self.db[self.restore_queue_collection].bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # restores already pending or running are kept as they are
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
+    def cancel_restore(self, host):
+        result = self.db[self.restore_queue_collection].remove({'_id': host, 'state': RESTORE_PENDING})
+        return result['n'] == 1
+
+    def restore_instances(self, now, created_in, stale_in):
+        return self.db[self.restore_queue_collection].distinct(
+            'instance', self._restore_due_query(now, created_in, stale_in))
+
+    def claim_restore(self, now, created_in, stale_in, instance=None):
+        """
+        Atomically moves the next restore due to the running state and
+        returns it, or None when nothing is due. Restores left running since
+        before stale_in, by a worker that died, are claimed again.
+        """
+        query = self._restore_due_query(now, created_in, stale_in)
+        if instance is not None:
+            query['instance'] = instance
+        return self.db[self.restore_queue_collection].find_one_and_update(
+            query, {'$set': {'state': RESTORE_RUNNING}, '$currentDate': {'claimed_at': True}},
+            sort=[('_id', pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+
+    def finish_restore(self, restore):
+        self.db[self.restore_queue_collection].update({'_id': restore['_id']},
+                                                      {'$set': {'state': RESTORE_DONE},
+                                                       '$currentDate': {'finished_at': True}})
+
+    def postpone_restore(self, restore, last_attempt, next_attempt_at):
+        """
+        Returns a failed restore to the queue, holding it and every other
+        pending restore of the same instance until next_attempt_at.
+        """
+        coll = self.db[self.restore_queue_collection]
+        coll.update({'_id': restore['_id']}, {'$set': {'state': RESTORE_PENDING, 'last_attempt': last_attempt,
+                                                       'next_attempt_at': next_attempt_at}})
+        coll.update({'instance': restore['instance'], 'state': RESTORE_PENDING,
+                     'next_attempt_at': {'$lt': next_attempt_at}},
+                    {'$set': {'next_attempt_at': next_attempt_at}}, multi=True)
+
+    def ensure_restore_queue(self):
+        """
+        Creates the restore queue indexes and moves the restores still kept
+        as restore_* documents in the tasks collection to the queue, once
+        per process. Restores that failed before keep their retry backoff,
+        computed from last_attempt when they have no next_attempt_at.
+        """
+        key = (self.mongo_uri, self.mongo_database, self.restore_queue_collection)
+        if key in indexed:
+            return
+        self.ensure_indexes([self.restore_queue_collection])
+        retry_delay = int(config.get_config("RESTORE_MACHINE_FAILURE_DELAY", 5, self.config))
+        tasks = list(self.db[self.tasks_collection].find({'_id': {'$regex': '^restore_'}}))
+        for task in tasks:
+            self.sync_restores([(task['host'], task['instance'])], created=task['created'])
+        # backoffs hold every restore of the instance, so they are applied
+        # once all of them are in the queue
+        for task in tasks:
+            next_attempt_at = task.get('next_attempt_at')
+            if next_attempt_at is None and task.get('last_attempt'):
+                next_attempt_at = task['last_attempt'] + datetime.timedelta(minutes=retry_delay)
+            if next_attempt_at is not None:
+                self.postpone_restore({'_id': task['host'], 'instance': task['instance']},
+                                      task.get('last_attempt'), next_attempt_at)
+            self.db[self.tasks_collection].remove({'_id': task['_id']})
+        indexed.add(key)
+
+    def _restore_due_query(self, now, created_in, stale_in):
+        return {'created': {'$lte': created_in}, 'next_attempt_at': {'$lte': now},
+                '$or': [{'state': RESTORE_PENDING},
+                        {'state': RESTORE_RUNNING, 'claimed_at': {'$lte': stale_in}}]}
+
+    def required_indexes(self):
+        """
+        Indexes backing the hot queries of this class, as (collection, keys,
+        options) tuples.
+        """
+        return [
+            (self.hosts_collection, [("dns_name", pymongo.ASCENDING)], {}),
+            (self.healing_collection, [("start_time", pymongo.DESCENDING)], {}),
+            (self.le_certificates_collection, [("created", pymongo.ASCENDING)], {}),
+            (self.restore_queue_collection, [("state", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING),
+                                             ("created", pymongo.ASCENDING)], {}),
+            (self.restore_queue_collection, [("instance", pymongo.ASCENDING), ("state", pymongo.ASCENDING)], {}),
+            (self.restore_queue_collection, [("finished_at", pymongo.ASCENDING)],
+             {"expireAfterSeconds": int(config.get_config("RESTORE_QUEUE_TTL", 7 * 24 * 3600, self.config))}),
+            (self.quota_collection, [("used", pymongo.ASCENDING)], {}),
+        ]
+
+    def ensure_indexes(self, collections=None):
+        existing = {}
+        for collection, keys, options in self.required_indexes():
+            if collections is not None and collection not in collections:
+                continue
+            if collection not in existing:
+                existing[collection] = dict((tuple(index["key"]), index) for index in
+                                            self.db[collection].index_information().values())
+            index = existing[collection].get(tuple(keys))
+            if index is None:
+                self.db[collection].create_index(keys, background=True, **options)
+            elif "expireAfterSeconds" in options and index.get("expireAfterSeconds") != options["expireAfterSeconds"]:
+                # a changed TTL would make create_index fail with an options
+                # conflict, the index is updated in place instead
+                self.db.command("collMod", collection, index={"keyPattern": bson.SON(keys),
+                                                              "expireAfterSeconds": options["expireAfterSeconds"]})
+
+    def missing_indexes(self):
+        existing = {}
+        missing = []
+        for collection, keys, options in self.required_indexes():
+            if collection not in existing:
+                indexes = self.db[collection].index_information().values()
+                existing[collection] = [list(index["key"]) for index in indexes]
+            if keys not in existing[collection]:
+                missing.append({"collection": collection, "keys": keys})
+        return missing
+
+    def query_plans(self):
+        """
+        Winning plan of the query behind each hot method of this class, to
+        spot the ones still scanning a whole collection.
+        """
+        now = datetime.datetime.utcnow()
+        queries = [
+            ("find_host_id", self.hosts_collection,
+             lambda coll: coll.find({"dns_name": ""})),
+            ("list_healings", self.healing_collection,
+             lambda coll: coll.find({}).sort("start_time", -1).limit(1)),
+            ("find_le_certificates", self.le_certificates_collection,
+             lambda coll: coll.find({"created": {"$lte": now}})),
+            ("claim_restore", self.restore_queue_collection,
+             lambda coll: coll.find(self._restore_due_query(now, now, now)).sort("_id", 1).limit(1)),
+            ("decrement_quota", self.quota_collection,
+             lambda coll: coll.find({"used": ""})),
+        ]
+        plans = []
+        for method, collection, query in queries:
+            explain = query(self.db[collection]).explain()
+            stages, indexes = _plan_stages(explain["queryPlanner"]["winningPlan"])
+            plans.append({"method": method, "collection": collection,
+                          "stages": stages, "indexes": indexes})
+        return plans
+
     def store_instance_metadata(self, instance_name, **data):
         data['_id'] = instance_name
         self.db[self.instance_metadata_collection].update({'_id': instance_name},
@@ -96,9 +303,29 @@ class MongoDBStorage(storage.MongoDBStorage):
     def find_host_id(self, name):
         return self.db[self.hosts_collection].find_one({'dns_name': name})
 
+    def find_host_names(self, names):
+        hosts = self.db[self.hosts_collection].find({'dns_name': {'$in': list(names)}}, {'dns_name': 1})
+        return set(host['dns_name'] for host in hosts)
+
     def remove_instance_metadata(self, instance_name):
         self.db[self.instance_metadata_collection].remove({'_id': instance_name})
 
+    def bump_lb_stamp(self, instance_name):
+        """
+        Marks the instance load balancer as changed, so every process drops
+        the copy it cached.
+        """
+        self.db[self.lb_stamps_collection].update({'_id': instance_name},
+                                                  {'$set': {'stamp': bson.ObjectId()}},
+                                                  upsert=True)
+
+    def find_lb_stamp(self, instance_name):
+        stamp = self.db[self.lb_stamps_collection].find_one({'_id': instance_name})
+        return stamp and stamp['stamp']
+
+    def remove_lb_stamp(self, instance_name):
+        self.db[self.lb_stamps_collection].remove({'_id': instance_name})
+
     def store_plan(self, plan):
         plan.validate()
         d = plan.to_dict()
@@ -108,6 +335,7 @@ class MongoDBStorage(storage.MongoDBStorage):
             self.db[self.plans_collection].insert(d)
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateError(plan.name)
+        self._bump_catalog_stamp(self.plans_collection)
 
     def update_plan(self, name, description=None, config=None):
         update = {}
@@ -120,19 +348,29 @@ class MongoDBStorage(storage.MongoDBStorage):
                                                            {"$set": update})
             if not result.get("updatedExisting"):
                 raise PlanNotFoundError()
+            self._bump_catalog_stamp(self.plans_collection)
 
     def delete_plan(self, name):
         result = self.db[self.plans_collection].remove({"_id": name})
         if result.get("n", 0) < 1:
             raise PlanNotFoundError()
+        self._bump_catalog_stamp(self.plans_collection)
 
     def find_plan(self, name):
+        plans = self._catalog(self.plans_collection, self._plan_from_dict)
+        if plans is not None:
+            if name not in plans:
+                raise PlanNotFoundError()
+            return plans[name]
         plan_dict = self.db[self.plans_collection].find_one({'_id': name})
         if not plan_dict:
             raise PlanNotFoundError()
         return self._plan_from_dict(plan_dict)
 
     def list_plans(self):
+        plans = self._catalog(self.plans_collection, self._plan_from_dict)
+        if plans is not None:
+            return plans.values()
         plan_list = self.db[self.plans_collection].find()
         return [self._plan_from_dict(p) for p in plan_list]
 
@@ -150,6 +388,7 @@ class MongoDBStorage(storage.MongoDBStorage):
             self.db[self.flavors_collection].insert(d)
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateError(flavor.name)
+        self._bump_catalog_stamp(self.flavors_collection)
 
     def update_flavor(self, name, description=None, config=None):
         update = {}
@@ -162,19 +401,29 @@ class MongoDBStorage(storage.MongoDBStorage):
                                                              {"$set": update})
             if not result.get("updatedExisting"):
                 raise FlavorNotFoundError()
+            self._bump_catalog_stamp(self.flavors_collection)
 
     def delete_flavor(self, name):
         result = self.db[self.flavors_collection].remove({"_id": name})
         if result.get("n", 0) < 1:
             raise FlavorNotFoundError()
+        self._bump_catalog_stamp(self.flavors_collection)
 
     def find_flavor(self, name):
+        flavors = self._catalog(self.flavors_collection, self._flavor_from_dict)
+        if flavors is not None:
+            if name not in flavors:
+                raise FlavorNotFoundError()
+            return flavors[name]
         flavor_dict = self.db[self.flavors_collection].find_one({'_id': name})
         if not flavor_dict:
             raise FlavorNotFoundError()
         return self._flavor_from_dict(flavor_dict)
 
     def list_flavors(self):
+        flavors = self._catalog(self.flavors_collection, self._flavor_from_dict)
+        if flavors is not None:
+            return flavors.values()
         flavor_list = self.db[self.flavors_collection].find()
         return [self._flavor_from_dict(p) for p in flavor_list]
 
@@ -183,60 +432,148 @@ class MongoDBStorage(storage.MongoDBStorage):
         del dict["_id"]
         return flavor.Flavor(**dict)
 
+    def _bump_catalog_stamp(self, collection):
+        self.db[self.catalog_stamps_collection].update({"_id": collection},
+                                                       {"$set": {"stamp": bson.ObjectId()}},
+                                                       upsert=True)
+
+    def _catalog(self, collection, from_dict):
+        """
+        Returns every item of a plans/flavors collection by name, reusing the
+        items already loaded by this process while the collection change
+        stamp is the same. Returns None when the collection has never been
+        changed through this class, so callers query it directly.
+        """
+        stamp = self.db[self.catalog_stamps_collection].find_one({"_id": collection})
+        if stamp is None:
+            return None
+        key = (self.mongo_uri, self.mongo_database, collection)
+        cached = catalogs.get(key)
+        if cached is not None and cached[0] == stamp["stamp"]:
+            return cached[1]
+        items = collections.OrderedDict()
+        for item in self.db[collection].find():
+            item = from_dict(item)
+            items[item.name] = item
+        catalogs[key] = (stamp["stamp"], items)
+        return items
+
     def store_binding(self, name, app_host):
-        try:
-            self.delete_binding_path(name, '/')
-        except:
-            pass
-        self.db[self.bindings_collection].update({'_id': name}, {
-            '$set': {'app_host': app_host},
-            '$push': {'paths': {
-                'path': '/',
-                'destination': app_host
-            }}
-        }, upsert=True)
+        self._set_binding_route(name, {'path': '/', 'destination': app_host}, {'app_host': app_host})
 
     def remove_binding(self, name):
         self.db[self.bindings_collection].remove({'_id': name})
 
     def remove_root_binding(self, name):
-        self.delete_binding_path(name, '/')
-        self.db[self.bindings_collection].update({'_id': name}, {
-            '$unset': {'app_host': '1'}
-        })
+        route = self._unset_binding_route(name, '/', {'app_host': 1})
+        if route.get('destination'):
+            self._release_destination(name, route['destination'])
 
     def find_binding(self, name):
-        return self.db[self.bindings_collection].find_one({'_id': name})
+        binding = self.db[self.bindings_collection].find_one({'_id': name}, {'destinations': 0})
+        if binding is None or 'paths' in binding:
+            return binding
+        routes = sorted((binding.pop('routes', None) or {}).values(), key=lambda route: route['seq'])
+        for route in routes:
+            del route['seq']
+        binding['paths'] = routes
+        return binding
 
     def replace_binding_path(self, name, path, destination=None, content=None):
-        try:
-            self.delete_binding_path(name, path)
-        except:
-            pass
-        self.db[self.bindings_collection].update({'_id': name}, {'$push': {'paths': {
-            'path': path,
-            'destination': destination,
-            'content': content,
-        }}}, upsert=True)
+        self._set_binding_route(name, {'path': path, 'destination': destination, 'content': content})
 
     def delete_binding_path(self, name, path):
-        result = self.db[self.bindings_collection].update({
-            '_id': name,
-            'paths.path': path,
-        }, {
-            '$pull': {
-                'paths': {
-                    'path': path
-                }
-            }
-        })
-        if result['n'] == 0:
+        """
+        Removes the route of path, returning its destination along with how
+        many routes of the binding still point to it.
+        """
+        route = self._unset_binding_route(name, path)
+        destination = route.get('destination')
+        if not destination:
+            return destination, 0
+        return destination, self._release_destination(name, destination)
+
+    def migrate_bindings(self):
+        """
+        Moves the routes of every binding still kept in the legacy paths
+        array to the routes map, instead of waiting for the next route
+        change of each binding. Returns how many bindings were migrated.
+        """
+        migrated = 0
+        for binding in self.db[self.bindings_collection].find({'paths': {'$exists': True}}, {'_id': 1}):
+            if self._migrate_binding(binding['_id']):
+                migrated += 1
+        return migrated
+
+    def _set_binding_route(self, name, route, fields=None):
+        key = _field_key(route['path'])
+        update = {'$set': dict(fields or {})}
+        update['$set']['routes.' + key] = dict(route, seq=bson.ObjectId())
+        if route.get('destination'):
+            update['$inc'] = {'destinations.' + _field_key(route['destination']): 1}
+        before = self._update_binding(name, {}, update, key, upsert=True)
+        previous = ((before or {}).get('routes') or {}).get(key)
+        if previous and previous.get('destination'):
+            self._release_destination(name, previous['destination'])
+
+    def _unset_binding_route(self, name, path, fields=None):
+        key = _field_key(path)
+        update = {'$unset': dict(fields or {})}
+        update['$unset']['routes.' + key] = 1
+        before = self._update_binding(name, {'routes.' + key: {'$exists': True}}, update, key)
+        if before is None:
             raise InstanceNotFoundError()
+        return before['routes'][key]
+
+    def _update_binding(self, name, query, update, key, upsert=False):
+        """
+        Applies update to the binding, returning the route stored under key
+        before it. Bindings still keeping their routes in the legacy paths
+        array are migrated first.
+        """
+        query = dict(query, _id=name, paths={'$exists': False})
+        coll = self.db[self.bindings_collection]
+        try:
+            before = coll.find_one_and_update(query, update, projection={'routes.' + key: 1}, upsert=upsert)
+        except pymongo.errors.DuplicateKeyError:
+            before = None
+        if before is None and self._migrate_binding(name):
+            before = coll.find_one_and_update(query, update, projection={'routes.' + key: 1}, upsert=upsert)
+        return before
+
+    def _migrate_binding(self, name):
+        binding = self.db[self.bindings_collection].find_one({'_id': name, 'paths': {'$exists': True}})
+        if binding is None:
+            return False
+        routes = {}
+        destinations = collections.Counter()
+        for route in binding['paths']:
+            routes[_field_key(route['path'])] = dict(route, seq=bson.ObjectId())
+            if route.get('destination'):
+                destinations[_field_key(route['destination'])] += 1
+        self.db[self.bindings_collection].update({'_id': name, 'paths': binding['paths']},
+                                                 {'$set': {'routes': routes, 'destinations': dict(destinations)},
+                                                  '$unset': {'paths': 1}})
+        return True
+
+    def _release_destination(self, name, destination):
+        key = 'destinations.' + _field_key(destination)
+        binding = self.db[self.bindings_collection].find_one_and_update(
+            {'_id': name}, {'$inc': {key: -1}}, projection={key: 1}, return_document=pymongo.ReturnDocument.AFTER)
+        if binding is None:
+            return 0
+        references = binding['destinations'][_field_key(destination)]
+        if references <= 0:
+            self.db[self.bindings_collection].update({'_id': name, key: {'$lte': 0}}, {'$unset': {key: 1}})
+        return references
 
     def set_team_quota(self, teamname, quota):
         q = self._find_team_quota(teamname)
         q['quota'] = quota
-        self.db[self.quota_collection].update({'_id': teamname}, {'$set': {'quota': quota}})
+        before = self.db[self.quota_collection].find_one_and_update({'_id': teamname}, {'$set': {'quota': quota}})
+        if 'remaining' in before:
+            self.db[self.quota_collection].update({'_id': teamname, 'remaining': {'$exists': True}},
+                                                  {'$inc': {'remaining': quota - before['quota']}})
         return q
 
     def find_team_quota(self, teamname):
@@ -246,18 +583,70 @@ class MongoDBStorage(storage.MongoDBStorage):
     def _find_team_quota(self, teamname):
         quota = self.db[self.quota_collection].find_one({'_id': teamname})
         if quota is None:
-            quota = {'_id': teamname, 'used': [], 'quota': 5}
+            quota = {'_id': teamname, 'used': [], 'quota': self.default_quota, 'remaining': self.default_quota}
             self.db[self.quota_collection].insert(quota)
         return quota
 
-    def increment_quota(self, teamname, prev_used, servicename):
-        result = self.db[self.quota_collection].update(
-            {'_id': teamname, 'used': prev_used},
-            {'$addToSet': {'used': servicename}})
-        return result['n'] == 1
-
-    def decrement_quota(self, servicename):
-        self.db[self.quota_collection].update({}, {'$pull': {'used': servicename}}, multi=True)
+    def reserve_quota(self, teamname, servicename):
+        """
+        Counts servicename in the team quota with a single atomic update,
+        conditional on the remaining counter of the quota, and returns
+        whether it is counted with the quota not exceeded, along with the
+        used instances and the quota as they were before.
+        """
+        coll = self.db[self.quota_collection]
+        query = {'_id': teamname, 'used': {'$ne': servicename}, 'remaining': {'$gt': 0}}
+        update = {'$push': {'used': servicename}, '$inc': {'remaining': -1}}
+        for _ in range(3):
+            before = coll.find_one_and_update(query, update)
+            if before is not None:
+                return True, before['used'], before['quota']
+            quota = coll.find_one({'_id': teamname})
+            if quota is None:
+                try:
+                    coll.insert({'_id': teamname, 'used': [servicename], 'quota': self.default_quota,
+                                 'remaining': self.default_quota - 1})
+                    return True, [], self.default_quota
+                except pymongo.errors.DuplicateKeyError:
+                    continue
+            if 'remaining' not in quota:
+                # quotas stored before the remaining counter was kept
+                coll.update({'_id': teamname, 'used': quota['used'], 'remaining': {'$exists': False}},
+                            {'$set': {'remaining': quota['quota'] - len(quota['used'])}})
+                continue
+            return servicename in quota['used'] and quota['remaining'] > 0, quota['used'], quota['quota']
+        quota = self._find_team_quota(teamname)
+        return False, quota['used'], quota['quota']
+
+    def decrement_quota(self, servicename, teamname=None):
+        coll = self.db[self.quota_collection]
+        pull = {'$pull': {'used': servicename}}
+        release = {'$pull': {'used': servicename}, '$inc': {'remaining': 1}}
+        if teamname is not None:
+            query = {'_id': teamname, 'used': servicename}
+            if coll.update(dict(query, remaining={'$exists': True}), release)['n'] == 1:
+                return
+            if coll.update(dict(query, remaining={'$exists': False}), pull)['n'] == 1:
+                return
+        # instances stored before the owning team was recorded along with
+        # them, or whose team no longer matches the quota document
+        coll.update({'used': servicename, 'remaining': {'$exists': True}}, release, multi=True)
+        coll.update({'used': servicename, 'remaining': {'$exists': False}}, pull, multi=True)
+
+    def backfill_instance_teams(self):
+        """
+        Records in the metadata of every instance counted in a team quota the
+        team owning it, so removing the instance releases the quota with a
+        single-document update. Returns how many instances were changed.
+        """
+        requests = []
+        for quota in self.db[self.quota_collection].find({}, {'used': 1}):
+            for name in quota.get('used', []):
+                requests.append(pymongo.UpdateOne({'_id': name, 'team': {'$ne': quota['_id']}},
+                                                  {'$set': {'team': quota['_id']}}))
+        if not requests:
+            return 0
+        return self.db[self.instance_metadata_collection].bulk_write(requests, ordered=False).modified_count
 
     def store_le_certificate(self, name, domain):
         doc = {"_id": name, "domain": domain,
@@ -277,3 +666,26 @@ class MongoDBStorage(storage.MongoDBStorage):
             certificate["name"] = certificate["_id"]
             del certificate["_id"]
             yield certificate
+
+
+def _field_key(value):
+    """
+    Escapes a path or destination to be used as a field name, which can't
+    hold dots nor start with a dollar sign.
+    """
+    return value.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def _plan_stages(plan):
+    stages = []
+    indexes = []
+    pending = [plan]
+    while pending:
+        stage = pending.pop(0)
+        stages.append(stage["stage"])
+        if "indexName" in stage:
+            indexes.append(stage["indexName"])
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+        pending.extend(stage.get("inputStages", []))
+    return stages, indexes
@@ -2,11 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import collections
 import copy
 import datetime
 import logging
 import os
 import sys
+import threading
 from urlparse import urlparse
 
 from celery import Celery, Task
@@ -20,7 +22,7 @@ from hm.model.load_balancer import LoadBalancer
 
 from rpaas import (consul_manager, hc, nginx, sslutils, ssl_plugins,
                    storage, celery_sentinel, acl, lock)
-from rpaas.misc import check_option_enable
+from rpaas.misc import check_option_enable, run_parallel
 
 possible_redis_envs = ['SENTINEL_ENDPOINT', 'DBAAS_SENTINEL_ENDPOINT', 'REDIS_ENDPOINT']
 
@@ -94,8 +96,8 @@ class TaskNotFoundError(Exception):
 
 class TaskManager(object):
 
-    def __init__(self, config=None):
-        self.storage = storage.MongoDBStorage(config)
+    def __init__(self, config=None, storage_manager=None):
+        self.storage = storage_manager or storage.MongoDBStorage(config)
 
     def ensure_ready(self, name):
         task = self.storage.find_task(name)
@@ -127,10 +129,10 @@ class BaseManagerTask(Task):
         self.consul_manager = consul_manager.ConsulManager(config)
         self.host_manager_name = self._get_conf("HOST_MANAGER", "cloudstack")
         self.lb_manager_name = self._get_conf("LB_MANAGER", "networkapi_cloudstack")
-        self.task_manager = TaskManager(config)
+        self.storage = storage.MongoDBStorage(config)
+        self.task_manager = TaskManager(config, self.storage)
         self.lock_manager = lock.Lock(app.backend.client)
         self.hc = hc.Dumb()
-        self.storage = storage.MongoDBStorage(config)
         self.acl_manager = acl.Dumb(self.consul_manager)
         if check_option_enable(self._get_conf("CHECK_ACL_API", None)):
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(app.backend.client))
@@ -145,40 +147,28 @@ class BaseManagerTask(Task):
     def _get_conf(self, key, default=config.undefined):
         return config.get_config(key, default, self.config)
 
-    def _add_host(self, name, lb=None):
+    def _add_host(self, name):
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
-        created_lb = None
+        lb = None
+        host = None
         try:
-            if not lb:
-                lb = created_lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
-                self.hc.create(name)
-            config = copy.deepcopy(self.config)
-            if hasattr(lb, 'dsr') and lb.dsr:
-                config["HOST_TAGS"] = config["HOST_TAGS"] + ",dsr_ip:{}".format(lb.address)
-            host = Host.create(self.host_manager_name, name, config)
-            lb.add_host(host)
+            lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
+            self.hc.create(name)
+            host = self._create_host(name, lb)
             self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
-            acls = self.consul_manager.find_acl_network(name)
-            if acls:
-                acl_host = acls.pop()
-                for dst in acl_host['destination']:
-                    self.acl_manager.add_acl(name, host.dns_name, dst)
-            self.hc.add_url(name, host.dns_name)
+            self._setup_host(name, host)
         except:
             exc_info = sys.exc_info()
-            rollback = self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
-            if not rollback:
+            if not self._rollback_enabled():
                 raise
             try:
-                if created_lb is not None:
-                    created_lb.destroy()
+                if lb is not None:
+                    lb.destroy()
             except Exception as e:
                 logging.error("Error in rollback trying to destroy load balancer: {}".format(e))
             try:
-                if created_lb is not None:
+                if host is not None:
                     self._delete_host(name, host)
-                else:
-                    self._delete_host(name, host, lb)
             except Exception as e:
                 logging.error("Error in rollback trying to destroy host: {}".format(e))
             try:
@@ -190,12 +180,44 @@ class BaseManagerTask(Task):
         finally:
             self.storage.remove_task(name)
 
-    def _delete_host(self, name, host, lb=None):
+    def _rollback_enabled(self):
+        return self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
+
+    def _create_host(self, name, lb, lb_lock=None):
+        config = copy.deepcopy(self.config)
+        if hasattr(lb, 'dsr') and lb.dsr:
+            config["HOST_TAGS"] = config["HOST_TAGS"] + ",dsr_ip:{}".format(lb.address)
+        host = Host.create(self.host_manager_name, name, config)
+        try:
+            with lb_lock or threading.Lock():
+                lb.add_host(host)
+        except:
+            exc_info = sys.exc_info()
+            if self._rollback_enabled():
+                try:
+                    host.destroy()
+                except Exception as e:
+                    logging.error("Error in rollback trying to destroy host: {}".format(e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.storage.bump_lb_stamp(name)
+        return host
+
+    def _setup_host(self, name, host):
+        acls = self.consul_manager.find_acl_network(name)
+        if acls:
+            acl_host = acls.pop()
+            for dst in acl_host['destination']:
+                self.acl_manager.add_acl(name, host.dns_name, dst)
+        self.hc.add_url(name, host.dns_name)
+
+    def _delete_host(self, name, host, lb=None, lb_lock=None):
         try:
             node_name = self.consul_manager.node_hostname(host.dns_name)
             host.destroy()
             if lb is not None:
-                lb.remove_host(host)
+                with lb_lock or threading.Lock():
+                    lb.remove_host(host)
+            self.storage.bump_lb_stamp(name)
             if node_name is not None:
                 self.consul_manager.remove_node(name, node_name, host.id)
             self.acl_manager.remove_acl(name, host.dns_name)
@@ -203,6 +225,48 @@ class BaseManagerTask(Task):
         finally:
             self.storage.remove_task(name)
 
+    def _delete_hosts(self, name, hosts, lb=None):
+        """
+        Tears ``hosts`` down concurrently, then removes the Consul keys of
+        their nodes in a single transaction and forces each node to leave.
+        Hosts that failed are left out of the Consul cleanup and the first
+        error is raised at the end.
+        """
+        hosts = list(hosts)
+        concurrency = int(self._get_conf("RPAAS_TEARDOWN_CONCURRENCY", 10))
+        lb_lock = threading.Lock()
+
+        def destroy(host):
+            node_name = self.consul_manager.node_hostname(host.dns_name)
+            host.destroy()
+            if lb is not None:
+                with lb_lock:
+                    lb.remove_host(host)
+            self.acl_manager.remove_acl(name, host.dns_name)
+            self.hc.remove_url(name, host.dns_name)
+            return node_name
+
+        try:
+            results = run_parallel(destroy, hosts, concurrency)
+            self.storage.bump_lb_stamp(name)
+            errors = [error for _, error in results if isinstance(error, Exception)]
+            for error in errors:
+                logging.error("Error removing host from instance {}: {}".format(name, error))
+            nodes = [(host, node_name) for host, node_name in results
+                     if node_name is not None and not isinstance(node_name, Exception)]
+            with self.consul_manager.transaction():
+                for host, node_name in nodes:
+                    self.consul_manager.remove_node_keys(name, node_name, host.id)
+            for _, node_name in nodes:
+                try:
+                    self.consul_manager.leave_node(node_name)
+                except Exception as e:
+                    logging.error("Error forcing node {} of instance {} to leave: {}".format(node_name, name, e))
+        finally:
+            self.storage.remove_task(name)
+        if errors:
+            raise errors[0]
+
 
 class NewInstanceTask(BaseManagerTask):
 
@@ -218,10 +282,10 @@ class RemoveInstanceTask(BaseManagerTask):
         lb = LoadBalancer.find(name, self.config)
         if lb is None:
             raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            self._delete_host(name, host, lb)
+        self._delete_hosts(name, lb.hosts, lb)
         self.consul_manager.destroy_instance(name)
         lb.destroy()
+        self.storage.remove_lb_stamp(name)
         for cert in self.storage.find_le_certificates({'name': name}):
             self.storage.remove_le_certificate(name, cert['domain'])
         self.hc.destroy(name)
@@ -238,14 +302,54 @@ class ScaleInstanceTask(BaseManagerTask):
             diff = quantity - len(lb.hosts)
             if diff == 0:
                 return
-            for i in xrange(abs(diff)):
-                if diff > 0:
-                    self._add_host(name, lb=lb)
-                else:
-                    self._delete_host(name, lb.hosts[i], lb)
+            if diff > 0:
+                self._add_hosts(name, lb, diff)
+                return
+            self._delete_hosts(name, lb.hosts[:abs(diff)], lb)
         finally:
             self.storage.remove_task(name)
 
+    def _add_hosts(self, name, lb, quantity):
+        """
+        Creates ``quantity`` hosts and adds them to ``lb``, then waits for
+        all their healthchecks at once, setting each host up as soon as it
+        is healthy. Hosts that never become healthy are rolled back when
+        RPAAS_ROLLBACK_ON_ERROR is set and the first error is raised at the
+        end.
+        """
+        concurrency = int(self._get_conf("RPAAS_SCALE_CONCURRENCY", 1))
+        healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        # hm load balancers are not thread safe, every change to lb.hosts
+        # goes through the same lock
+        lb_lock = threading.Lock()
+        created = run_parallel(lambda _: self._create_host(name, lb, lb_lock), xrange(quantity), concurrency)
+        errors = [host for _, host in created if isinstance(host, Exception)]
+        pending = [host for _, host in created if not isinstance(host, Exception)]
+        failed = []
+        waits = self.nginx_manager.wait_healthcheck_many([host.dns_name for host in pending],
+                                                         timeout=healthcheck_timeout)
+        for address, error in waits:
+            host = next(host for host in pending if host.dns_name == address)
+            pending.remove(host)
+            if error is None:
+                try:
+                    self._setup_host(name, host)
+                    continue
+                except Exception as e:
+                    error = e
+            errors.append(error)
+            failed.append(host)
+        if failed and self._rollback_enabled():
+            for host in failed:
+                try:
+                    self._delete_host(name, host, lb, lb_lock)
+                except Exception as e:
+                    logging.error("Error in rollback trying to destroy host: {}".format(e))
+        for error in errors:
+            logging.error("Error adding host to instance {}: {}".format(name, error))
+        if errors:
+            raise errors[0]
+
 
 class RestoreMachineTask(BaseManagerTask):
 
@@ -254,58 +358,118 @@ class RestoreMachineTask(BaseManagerTask):
         lock_name = self.config.get("RESTORE_LOCK_NAME", "restore_lock")
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         restore_delay = int(self.config.get("RESTORE_MACHINE_DELAY", 5))
-        created_in = datetime.datetime.utcnow() - datetime.timedelta(minutes=restore_delay)
-        restore_query = {"_id": {"$regex": "restore_.+"}, "created": {"$lte": created_in}}
+        now = datetime.datetime.utcnow()
+        created_in = now - datetime.timedelta(minutes=restore_delay)
+        claim_timeout = int(self.config.get("RESTORE_MACHINE_CLAIM_TIMEOUT", 3600))
+        stale_in = now - datetime.timedelta(seconds=claim_timeout)
+        self.storage.ensure_restore_queue()
+        concurrency = int(self.config.get("RESTORE_MACHINE_CONCURRENCY", 1))
+        if concurrency > 1:
+            self._restore_concurrently(now, created_in, stale_in, config, healthcheck_timeout, lock_name,
+                                       concurrency)
+            return
         if self.lock_manager.lock(lock_name, timeout=(healthcheck_timeout + 60)):
-            for task in self.storage.find_task(restore_query):
+            for task in self._claim_restores(now, created_in, stale_in):
                 try:
                     start_time = datetime.datetime.utcnow()
                     self._restore_machine(task, config, healthcheck_timeout)
                     elapsed_time = datetime.datetime.utcnow() - start_time
                     self.lock_manager.extend_lock(lock_name, extra_time=elapsed_time.seconds)
                 except Exception as e:
-                    self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
+                    self._postpone_task(task)
                     self.lock_manager.unlock(lock_name)
                     raise e
             self.lock_manager.unlock(lock_name)
 
-    def _restore_machine(self, task, config, healthcheck_timeout):
+    def _claim_restores(self, now, created_in, stale_in, instance=None):
+        task = self.storage.claim_restore(now, created_in, stale_in, instance)
+        while task is not None:
+            yield task
+            task = self.storage.claim_restore(now, created_in, stale_in, instance)
+
+    def _postpone_task(self, task):
         retry_failure_delay = int(self.config.get("RESTORE_MACHINE_FAILURE_DELAY", 5))
-        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
-        retry_failure_query = {"_id": {"$regex": "restore_.+"}, "last_attempt": {"$ne": None}}
-        if task['instance'] not in self._failure_instances(retry_failure_query, retry_failure_delay):
-            host = self.storage.find_host_id(task['host'])
-            if not restore_dry_mode:
-                healing_id = self.storage.store_healing(task['instance'], task['host'])
+        last_attempt = datetime.datetime.utcnow()
+        next_attempt_at = last_attempt + datetime.timedelta(minutes=retry_failure_delay)
+        self.storage.postpone_restore(task, last_attempt, next_attempt_at)
+
+    def _restore_concurrently(self, now, created_in, stale_in, config, healthcheck_timeout, lock_name,
+                              concurrency):
+        """
+        Restores machines of different instances at the same time. Each
+        instance is healed serially under its own lock, and a pool of
+        `concurrency` slot locks caps how many instances are healed at once
+        across every worker.
+        """
+        instances = self.storage.restore_instances(now, created_in, stale_in)
+        lock_timeout = healthcheck_timeout + 60
+        slots = ["{}:slot:{}".format(lock_name, i) for i in xrange(concurrency)]
+
+        def restore_instance(instance):
+            # redis locks are not shared between threads, every instance gets
+            # its own lock manager
+            locks = lock.Lock(self.lock_manager.redis_conn)
+            slot = next((s for s in slots if locks.lock(s, timeout=lock_timeout)), None)
+            if slot is None:
+                return
+            instance_lock = "{}:{}".format(lock_name, instance)
+            try:
+                if not locks.lock(instance_lock, timeout=lock_timeout):
+                    return
                 try:
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).restore()
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).start()
-                    self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
-                    self.storage.update_healing(healing_id, "success")
-                except Exception as e:
-                    self.storage.update_healing(healing_id, str(e.message))
-                    raise e
-            self.storage.remove_task({"_id": task['_id']})
+                    for task in self._claim_restores(now, created_in, stale_in, instance):
+                        start_time = datetime.datetime.utcnow()
+                        try:
+                            self._restore_machine(task, config, healthcheck_timeout)
+                        except:
+                            self._postpone_task(task)
+                            raise
+                        elapsed_time = datetime.datetime.utcnow() - start_time
+                        locks.extend_lock(instance_lock, extra_time=elapsed_time.seconds)
+                        locks.extend_lock(slot, extra_time=elapsed_time.seconds)
+                finally:
+                    locks.unlock(instance_lock)
+            finally:
+                locks.unlock(slot)
 
-    def _failure_instances(self, retry_failure_query, retry_failure_delay):
-        failure_instances = set()
-        for task in self.storage.find_task(retry_failure_query):
-            retry_failure = task['last_attempt'] + datetime.timedelta(minutes=retry_failure_delay)
-            if (retry_failure >= datetime.datetime.utcnow()):
-                failure_instances.add(task['instance'])
-        return failure_instances
+        results = run_parallel(restore_instance, instances, concurrency)
+        errors = [result for _, result in results if isinstance(result, Exception)]
+        for error in errors:
+            logging.error("Error restoring machines: {}".format(error))
+        if errors:
+            raise errors[0]
+
+    def _restore_machine(self, task, config, healthcheck_timeout):
+        restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
+        host = self.storage.find_host_id(task['host'])
+        if not restore_dry_mode:
+            healing_id = self.storage.store_healing(task['instance'], task['host'])
+            try:
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).restore()
+                self.storage.bump_lb_stamp(task['instance'])
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).start()
+                self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
+                self.storage.update_healing(healing_id, "success")
+            except Exception as e:
+                self.storage.update_healing(healing_id, str(e.message))
+                raise e
+        self.storage.finish_restore(task)
 
 
 class CheckMachineTask(BaseManagerTask):
 
     def run(self, config):
         self.init_config(config)
-        for node in self.consul_manager.service_healthcheck():
-            node_fail = False
+        nodes = self.consul_manager.service_healthcheck()
+        known_hosts = self.storage.find_host_names(node['Node']['Address'] for node in nodes)
+        now = datetime.datetime.utcnow()
+        failing = collections.OrderedDict()
+        passing = []
+        for node in nodes:
             address = node['Node']['Address']
-            if not self._check_machine_exists(address):
+            if address not in known_hosts:
                 logging.error("check_machine: machine {} not found".format(address))
                 continue
             service_instance = self.config['RPAAS_SERVICE_NAME']
@@ -313,30 +477,17 @@ class CheckMachineTask(BaseManagerTask):
                 if self.config['RPAAS_SERVICE_NAME'] in tag:
                     continue
                 service_instance = tag
-            for check in node['Checks']:
-                if check['Status'] != 'passing':
-                    node_fail = True
-                    break
-            task_name = "restore_{}".format(address)
-            if node_fail:
-                try:
-                    self.task_manager.ensure_ready(task_name)
-                    self.task_manager.create({"_id": task_name, "host": address,
-                                              "instance": service_instance,
-                                              "created": datetime.datetime.utcnow()})
-                except:
-                    pass
+            if any(check['Status'] != 'passing' for check in node['Checks']):
+                failing[address] = service_instance
             else:
-                try:
-                    self.task_manager.remove(task_name)
-                except:
-                    pass
-
-    def _check_machine_exists(self, address):
-        machine_data = self.storage.find_host_id(address)
-        if machine_data is None:
-            return False
-        return True
+                passing.append(address)
+        if not failing and not passing:
+            return
+        states = self.storage.find_restore_states(failing.keys() + passing)
+        enqueue = [(host, instance) for host, instance in failing.items()
+                   if states.get(host, storage.RESTORE_DONE) == storage.RESTORE_DONE]
+        cancel = [host for host in passing if states.get(host) == storage.RESTORE_PENDING]
+        self.storage.sync_restores(enqueue, cancel, now)
 
 
 class DownloadCertTask(BaseManagerTask):
@@ -161,8 +161,18 @@ class FakeManager(object):
     def purge_location(self, name, path, preserve_path):
         _, instance = self.find_instance(name)
         if preserve_path:
-            return 3
-        return 4
+            hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+            variants = ["gzip", "identity"]
+        else:
+            hosts = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]
+            variants = ["http/gzip", "http/identity", "https/gzip", "https/identity"]
+        results = dict((host, dict((v, "not purged") for v in variants)) for host in hosts)
+        for host in hosts:
+            results[host][variants[0]] = "purged"
+        return results
+
+    def purge_locations(self, name, paths, preserve_path):
+        return dict((path, self.purge_location(name, path, preserve_path)) for path in paths)
 
     def reset(self):
         self.instances = []
@@ -174,7 +184,7 @@ class FakeManager(object):
         if machine != 'foo':
             raise manager.InstanceMachineNotFoundError()
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
         if name in "invalid":
             yield "instance {} not found".format(name)
             return
@@ -216,6 +226,12 @@ class FakeManager(object):
         _, instance = self.find_instance(name)
         return instance.upstreams[upstream_name]
 
+    def migrate_upstreams(self, name):
+        _, instance = self.find_instance(name)
+        if not instance:
+            raise storage.InstanceNotFoundError()
+        return sorted(instance.upstreams.keys())
+
     def swap(self, instance_a, instance_b):
         _, instance_a = self.find_instance(instance_a)
         _, instance_b = self.find_instance(instance_b)
@@ -8,7 +8,7 @@ import unittest
 import os
 
 from bson import json_util
-from rpaas import api, storage, admin_api
+from rpaas import api, storage, admin_api, cache, consul_manager, nginx
 from . import managers
 
 
@@ -379,6 +379,19 @@ class AdminAPITestCase(unittest.TestCase):
         response = ["host a restored", "host b restored"]
         self.assertEqual("".join(response), resp.data)
 
+    def test_restore_instance_max_unavailable(self):
+        resp = self.api.post("/admin/restore", data={"instance_name": "blah", "max_unavailable": "25%"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("host a restoredhost b restored", resp.data)
+
+    def test_restore_instance_invalid_max_unavailable(self):
+        for max_unavailable in ["abc", "12.5%", "0", "-2", "0%", "150%"]:
+            resp = self.api.post("/admin/restore", data={"instance_name": "blah",
+                                                         "max_unavailable": max_unavailable})
+            self.assertEqual(400, resp.status_code, max_unavailable)
+            self.assertEqual("max_unavailable must be a positive integer or a percentage between 1% and 100%",
+                             resp.data)
+
     def test_restore_invalid_instance_name(self):
         resp = self.api.post("/admin/restore", data={"instance_name": "invalid"})
         self.assertEqual(200, resp.status_code)
@@ -389,3 +402,50 @@ class AdminAPITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         response = ["host a restored", "host b restored", "host c failed to restore"]
         self.assertEqual("".join(response), resp.data)
+
+    def test_migrate_upstreams(self):
+        self.manager.new_instance("blah")
+        self.manager.add_upstream("blah", "blah", "10.0.0.1:8080")
+        resp = self.api.post("/admin/upstreams/migrate", data={"instance_name": "blah"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"migrated": ["blah"]}, json.loads(resp.data))
+
+    def test_migrate_upstreams_instance_not_found(self):
+        resp = self.api.post("/admin/upstreams/migrate", data={"instance_name": "blah"})
+        self.assertEqual(404, resp.status_code)
+        resp = self.api.post("/admin/upstreams/migrate")
+        self.assertEqual(400, resp.status_code)
+
+    def test_stats(self):
+        consul_manager.cas_stats.clear()
+        consul_manager.cas_stats.incr("attempts")
+        nginx.retry_stats.clear()
+        nginx.retry_stats.record("purge_location", 2, 0.5, False)
+        cache.load_balancers.clear()
+        cache.load_balancers.get("blah", 5)
+        resp = self.api.get("/admin/stats")
+        self.assertEqual(200, resp.status_code)
+        stats = json.loads(resp.data)
+        self.assertEqual(os.getpid(), stats["pid"])
+        self.assertEqual({"attempts": 1, "conflicts": 0, "exhausted": 0}, stats["consul_cas"])
+        self.assertEqual({"purge_location": {"calls": 1, "attempts": 2, "failures": 0, "latency": 0.5}},
+                         stats["nginx_retries"])
+        self.assertEqual({"size": 0, "hits": 0, "misses": 1, "invalidations": 0}, stats["lb_cache"])
+
+    def test_list_indexes(self):
+        self.storage.db[self.storage.hosts_collection].insert({"_id": 0, "dns_name": "10.1.1.1"})
+        resp = self.api.get("/admin/indexes")
+        self.assertEqual(200, resp.status_code)
+        report = json.loads(resp.data)
+        self.assertIn({"collection": "hosts", "keys": [["dns_name", 1]]}, report["missing"])
+        plans = dict((plan["method"], plan) for plan in report["plans"])
+        self.assertIn("COLLSCAN", plans["find_host_id"]["stages"])
+
+    def test_create_indexes(self):
+        resp = self.api.post("/admin/indexes")
+        self.assertEqual(200, resp.status_code)
+        report = json.loads(resp.data)
+        self.assertEqual([], report["missing"])
+        plans = dict((plan["method"], plan) for plan in report["plans"])
+        self.assertIn("IXSCAN", plans["find_host_id"]["stages"])
+        self.assertEqual(["dns_name_1"], plans["find_host_id"]["indexes"])
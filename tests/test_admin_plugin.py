@@ -777,3 +777,80 @@ Config:
         with self.assertRaises(SystemExit):
             admin_plugin.restore_instance(args)
         stderr.write.assert_has_calls([mock.call("ERROR: fail\n")])
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_indexes(self, stdout, Request, urlopen):
+        lines = []
+        stdout.write.side_effect = lambda data, **kw: lines.append(data)
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        result.read.return_value = json.dumps({
+            "missing": [{"collection": "hosts", "keys": [["dns_name", 1]]}],
+            "plans": [{"method": "find_host_id", "collection": "hosts", "stages": ["COLLSCAN"], "indexes": []},
+                      {"method": "list_healings", "collection": "healing",
+                       "stages": ["LIMIT", "FETCH", "IXSCAN"], "indexes": ["start_time_-1"]}],
+        })
+        urlopen.return_value = result
+        admin_plugin.indexes(["-s", self.service_name])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?" +
+                                   "callback=/admin/indexes")
+        self.assertEqual("GET", request.get_method())
+        expected_output = u"""Missing index on hosts: dns_name 1
+
++---------------+------------+--------------------------+---------------+
+| Method        | Collection | Plan                     | Indexes       |
++---------------+------------+--------------------------+---------------+
+| find_host_id  | hosts      | COLLSCAN                 |               |
++---------------+------------+--------------------------+---------------+
+| list_healings | healing    | LIMIT <- FETCH <- IXSCAN | start_time_-1 |
++---------------+------------+--------------------------+---------------+
+"""
+        self.assertEqual(expected_output, "".join(lines))
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_indexes_create(self, stdout, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        result.read.return_value = json.dumps({"missing": [], "plans": []})
+        urlopen.return_value = result
+        admin_plugin.indexes(["-s", self.service_name, "--create"])
+        self.assertEqual("POST", request.get_method())
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_migrate_upstreams(self, stdout, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        result.read.return_value = json.dumps({"migrated": ["myinstance", "backend"]})
+        urlopen.return_value = result
+        admin_plugin.migrate_upstreams(["-s", self.service_name, "-i", "myinstance"])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?" +
+                                   "callback=/admin/upstreams/migrate")
+        self.assertEqual("POST", request.get_method())
+        request.add_data.assert_called_with("instance_name=myinstance")
+        stdout.write.assert_called_with("Migrated upstreams: backend, myinstance.\n")
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_migrate_upstreams_nothing_to_migrate(self, stdout, Request, urlopen):
+        Request.return_value = mock.Mock()
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        result.read.return_value = json.dumps({"migrated": []})
+        urlopen.return_value = result
+        admin_plugin.migrate_upstreams(["-s", self.service_name, "-i", "myinstance"])
+        stdout.write.assert_called_with("No upstream to migrate.\n")
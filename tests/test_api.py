@@ -649,12 +649,32 @@ class APITestCase(unittest.TestCase):
             'path': '/somewhere', 'preserve_path': True
         }, headers={'Content-Type': 'application/x-www-form-urlencoded'})
         self.assertEqual(200, resp.status_code)
-        self.assertEqual('Path found and purged on 3 servers', resp.data)
+        self.assertEqual("Path found and purged on 3 servers\n"
+                         "10.0.0.1: gzip purged, identity not purged\n"
+                         "10.0.0.2: gzip purged, identity not purged\n"
+                         "10.0.0.3: gzip purged, identity not purged", resp.data)
         resp = self.api.post("/resources/someapp/purge", data={
             'path': '/somewhere', 'preserve_path': 'False'
         }, headers={'Content-Type': 'application/x-www-form-urlencoded'})
         self.assertEqual(200, resp.status_code)
-        self.assertEqual('Path found and purged on 4 servers', resp.data)
+        lines = resp.data.split("\n")
+        self.assertEqual("Path found and purged on 4 servers", lines[0])
+        self.assertEqual("10.0.0.4: http/gzip purged, http/identity not purged, "
+                         "https/gzip not purged, https/identity not purged", lines[4])
+
+    def test_purge_locations(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data={
+            'path': ['/somewhere', '/elsewhere'], 'preserve_path': 'False'
+        }, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("/elsewhere: purged on 4 of 4 servers\n"
+                         "/somewhere: purged on 4 of 4 servers", resp.data)
+
+    def test_purge_locations_without_path(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data={'preserve_path': 'False'},
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("missing required path", resp.data)
 
     def open_with_auth(self, url, method, user, password, data=None, headers=None):
         encoded = base64.b64encode(user + ":" + password)
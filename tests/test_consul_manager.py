@@ -2,6 +2,8 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import base64
+import json
 import os
 import unittest
 import mock
@@ -233,6 +235,47 @@ class ConsulManagerTestCase(unittest.TestCase):
         key_item = self.consul.kv.get("test-suite-rpaas/myrpaas/ssl/key")
         self.assertEqual("key\nvalid\n\n", key_item[1]["Value"])
 
+    def test_set_certificate_single_transaction(self):
+        with mock.patch.object(self.manager.client.http, "put", return_value=True) as put:
+            self.manager.set_certificate("myrpaas", "certificate", "key")
+        self.assertEqual(1, put.call_count)
+        callback, path = put.call_args[0]
+        self.assertEqual("/v1/txn", path)
+        ops = json.loads(put.call_args[1]["data"])
+        self.assertEqual([{"KV": {"Verb": "set", "Key": "test-suite-rpaas/myrpaas/ssl/cert",
+                                  "Value": base64.b64encode("certificate")}},
+                          {"KV": {"Verb": "set", "Key": "test-suite-rpaas/myrpaas/ssl/key",
+                                  "Value": base64.b64encode("key")}}], ops)
+
+    def test_transaction_chunks_operations(self):
+        self.manager.txn_max_ops = 2
+        with mock.patch.object(self.manager.client.http, "put", return_value=True) as put:
+            with self.manager.transaction():
+                self.manager.set_certificate("myrpaas", "certificate", "key")
+                self.manager.swap_instances("myrpaas", "otherrpaas")
+        self.assertEqual(2, put.call_count)
+        self.assertEqual([2, 2], [len(json.loads(c[1]["data"])) for c in put.call_args_list])
+
+    def test_transaction_conflict(self):
+        response = consul.base.Response(409, {}, json.dumps({"Errors": [{"OpIndex": 0, "What": "failed"}]}))
+        with mock.patch.object(self.manager.client.http, "put",
+                               side_effect=lambda callback, *args, **kwargs: callback(response)):
+            with self.assertRaises(consul_manager.TransactionError):
+                self.manager.set_certificate("myrpaas", "certificate", "key")
+
+    def test_transaction_falls_back_to_single_writes(self):
+        http_put = self.manager.client.http.put
+
+        def put(callback, path, params=None, data=''):
+            if path == "/v1/txn":
+                return callback(consul.base.Response(404, {}, ""))
+            return http_put(callback, path, params, data)
+
+        with mock.patch.object(self.manager.client.http, "put", side_effect=put):
+            self.manager.set_certificate("myrpaas", "certificate", "key")
+        self.assertFalse(self.manager.txn_supported)
+        self.assertEqual(("certificate", "key"), self.manager.get_certificate("myrpaas"))
+
     def test_remove_location_root(self):
         self.manager.write_location("myrpaas", "/",
                                     destination="http://myapp.tsuru.io",
@@ -354,6 +397,57 @@ class ConsulManagerTestCase(unittest.TestCase):
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server3:789", "server2:456", "server1:123"]), servers)
 
+    def test_upstream_add_retries_on_concurrent_update(self):
+        consul_manager.cas_stats.clear()
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        key = "test-suite-rpaas/myrpaas/upstream/upstream1"
+        original_get = self.manager.client.kv.get
+        gets = []
+
+        def get(*args, **kwargs):
+            result = original_get(*args, **kwargs)
+            if not gets:
+                self.consul.kv.put(key, self.manager._upstream_content(set(["server1", "server2"])))
+            gets.append(args)
+            return result
+
+        with mock.patch.object(self.manager.client.kv, "get", side_effect=get):
+            self.manager.add_server_upstream("myrpaas", "upstream1", "server3")
+        servers = self.manager.list_upstream("myrpaas", "upstream1")
+        self.assertEqual(set(["server1", "server2", "server3"]), servers)
+        self.assertEqual({"attempts": 3, "conflicts": 1, "exhausted": 0}, consul_manager.cas_stats.stats())
+
+    def test_upstream_add_gives_up_after_retries(self):
+        self.manager.cas_retries = 2
+        self.manager.cas_backoff = 0
+        with mock.patch.object(self.manager.client.kv, "put", return_value=False) as put:
+            with self.assertRaises(consul_manager.UpstreamConflictError):
+                self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        self.assertEqual(3, put.call_count)
+
+    def test_upstream_keys_layout(self):
+        self.manager.upstream_layout = "keys"
+        self.manager.add_server_upstream("myrpaas", "upstream1", ["server1", "http://server2:8080"])
+        self.manager.remove_server_upstream("myrpaas", "upstream1", "server1")
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server3")
+        servers = self.manager.list_upstream("myrpaas", "upstream1")
+        self.assertEqual(set(["server2:8080", "server3"]), servers)
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream_servers/upstream1/server2:8080")
+        self.assertEqual("server2:8080", item[1]["Value"])
+        self.assertIsNone(self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")[1])
+
+    def test_upstream_keys_layout_migrates_legacy_value(self):
+        self.manager.add_server_upstream("myrpaas", "upstream1", ["server1", "server2"])
+        self.manager.add_server_upstream("myrpaas", "upstream2", "server3")
+        self.manager.upstream_layout = "keys"
+        self.assertEqual(set(["server1", "server2"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server4")
+        self.assertIsNone(self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream1")[1])
+        self.assertEqual(set(["server1", "server2", "server4"]), self.manager.list_upstream("myrpaas", "upstream1"))
+        self.assertEqual(["upstream2"], self.manager.migrate_upstreams("myrpaas"))
+        self.assertIsNone(self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/upstream2")[1])
+        self.assertEqual(set(["server3"]), self.manager.list_upstream("myrpaas", "upstream2"))
+
     def test_upstream_remove_server_from_upstream(self):
         self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
         self.manager.add_server_upstream("myrpaas", "upstream1", "server2")
@@ -510,3 +604,37 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.manager.swap_instances("myrpaas-1", "myrpaas-2")
         with self.assertRaises(consul_manager.InstanceAlreadySwappedError):
             self.manager.swap_instances("myrpaas-1", "myrpaas-3")
+
+
+class NodeIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.catalog.nodes.return_value = (1, [{"Node": "vm-1", "Address": "10.0.0.1"},
+                                                      {"Node": "vm-2", "Address": "10.0.0.2"}])
+        self.index = consul_manager.NodeIndex(miss_interval=60)
+
+    def test_lookups_share_one_catalog_read(self):
+        self.assertEqual("vm-1", self.index.get(self.client, "10.0.0.1", 30))
+        self.assertEqual("vm-2", self.index.get(self.client, "10.0.0.2", 30))
+        self.assertIsNone(self.index.get(self.client, "10.0.0.3", 30))
+        self.assertEqual(1, self.client.catalog.nodes.call_count)
+
+    def test_reloads_when_expired(self):
+        self.index.get(self.client, "10.0.0.1", 30)
+        self.index.loaded_at -= 31
+        self.client.catalog.nodes.return_value = (2, [{"Node": "vm-3", "Address": "10.0.0.1"}])
+        self.assertEqual("vm-3", self.index.get(self.client, "10.0.0.1", 30))
+        self.assertEqual(2, self.client.catalog.nodes.call_count)
+
+    def test_reloads_on_miss_after_interval(self):
+        self.index.get(self.client, "10.0.0.1", 30)
+        self.index.loaded_at -= 61
+        self.client.catalog.nodes.return_value = (2, [{"Node": "vm-3", "Address": "10.0.0.3"}])
+        self.assertEqual("vm-3", self.index.get(self.client, "10.0.0.3", 300))
+
+    def test_discard(self):
+        self.index.get(self.client, "10.0.0.1", 30)
+        self.index.discard("vm-1")
+        self.assertIsNone(self.index.nodes.get("10.0.0.1"))
+        self.assertEqual("vm-2", self.index.nodes.get("10.0.0.2"))
@@ -69,29 +69,35 @@ class RestoreMachineTestCase(unittest.TestCase):
 
         now = datetime.datetime.utcnow()
         tasks = [
-            {"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "foo",
-             "created": now - datetime.timedelta(minutes=8)},
-            {"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "bar",
-             "created": now - datetime.timedelta(minutes=3)},
-            {"_id": "restore_10.3.3.3", "host": "10.3.3.3", "instance": "foo",
-             "created": now - datetime.timedelta(minutes=5)},
-            {"_id": "restore_10.4.4.4", "host": "10.4.4.4", "instance": "foo",
-             "created": now - datetime.timedelta(minutes=10)},
-            {"_id": "restore_10.5.5.5", "host": "10.5.5.5", "instance": "bar",
-             "created": now - datetime.timedelta(minutes=15)},
+            {"_id": "10.1.1.1", "host": "10.1.1.1", "instance": "foo",
+             "state": "pending", "created": now - datetime.timedelta(minutes=8)},
+            {"_id": "10.2.2.2", "host": "10.2.2.2", "instance": "bar",
+             "state": "pending", "created": now - datetime.timedelta(minutes=3)},
+            {"_id": "10.3.3.3", "host": "10.3.3.3", "instance": "foo",
+             "state": "pending", "created": now - datetime.timedelta(minutes=5)},
+            {"_id": "10.4.4.4", "host": "10.4.4.4", "instance": "foo",
+             "state": "pending", "created": now - datetime.timedelta(minutes=10)},
+            {"_id": "10.5.5.5", "host": "10.5.5.5", "instance": "bar",
+             "state": "pending", "created": now - datetime.timedelta(minutes=15)},
         ]
         FakeManager.host_id = 0
         FakeManager.hosts = ['10.1.1.1', '10.2.2.2', '10.3.3.3', '10.4.4.4', '10.5.5.5']
 
         for task in tasks:
             Host.create("fake", task['instance'], self.config)
-            self.storage.store_task(task)
+            task["next_attempt_at"] = task["created"]
+            self.storage.db[self.storage.restore_queue_collection].insert(task)
 
         redis.StrictRedis().flushall()
 
     def tearDown(self):
         FakeManager.fail_ids = []
 
+    def pending_restores(self):
+        restores = self.storage.db[self.storage.restore_queue_collection].find(
+            {"state": {"$ne": storage.RESTORE_DONE}}).sort("_id", 1)
+        return [restore['_id'] for restore in restores]
+
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
     def test_restore_machine_success(self, log, nginx):
@@ -105,8 +111,60 @@ class RestoreMachineTestCase(unittest.TestCase):
         nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
                                 call('10.4.4.4', timeout=600), call('10.5.5.5', timeout=600)]
         self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(tasks, ['restore_10.2.2.2'])
+        tasks = self.pending_restores()
+        self.assertListEqual(tasks, ['10.2.2.2'])
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_concurrently(self, log, nginx):
+        self.config['RESTORE_MACHINE_CONCURRENCY'] = 2
+        FakeManager.fail_ids = [2]
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertItemsEqual(log.info.call_args_list, [call("Machine 0 restored"), call("Machine 4 restored")])
+        self.assertItemsEqual(nginx_manager.wait_healthcheck.call_args_list,
+                              [call('10.1.1.1', timeout=600), call('10.5.5.5', timeout=600)])
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.2.2.2', '10.3.3.3', '10.4.4.4'], tasks)
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_concurrently_skips_locked_instance(self, log, nginx):
+        self.config['RESTORE_MACHINE_CONCURRENCY'] = 2
+        nginx_manager = nginx.Nginx.return_value
+        instance_lock = redis.StrictRedis().lock("restore_lock:foo", timeout=60)
+        instance_lock.acquire(blocking=False)
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        instance_lock.release()
+        self.assertEqual(log.info.call_args_list, [call("Machine 4 restored")])
+        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.5.5.5', timeout=600)])
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.1.1.1', '10.2.2.2', '10.3.3.3',
+                              '10.4.4.4'], tasks)
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_skips_instances_waiting_retry(self, log, nginx):
+        now = datetime.datetime.utcnow()
+        self.storage.db[self.storage.restore_queue_collection].update(
+            {"_id": "10.3.3.3"},
+            {"$set": {"last_attempt": now, "next_attempt_at": now + datetime.timedelta(minutes=5)}})
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertEqual(log.info.call_args_list, [call("Machine 4 restored")])
+        self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.5.5.5', timeout=600)])
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.1.1.1', '10.2.2.2', '10.3.3.3',
+                              '10.4.4.4'], tasks)
 
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
@@ -119,8 +177,8 @@ class RestoreMachineTestCase(unittest.TestCase):
         restorer.stop()
         self.assertListEqual(log.info.call_args_list, [])
         self.assertListEqual(nginx_manager.wait_healthcheck.call_args_list, [])
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(tasks, ['restore_10.2.2.2'])
+        tasks = self.pending_restores()
+        self.assertListEqual(tasks, ['10.2.2.2'])
 
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
@@ -131,9 +189,9 @@ class RestoreMachineTestCase(unittest.TestCase):
         restorer.start()
         time.sleep(1)
         restorer.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3',
-                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.2.2.2', '10.3.3.3',
+                              '10.4.4.4', '10.5.5.5'], tasks)
         self.assertEqual(log.info.call_args_list, [call("Machine 0 restored")])
         self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600)])
         log.reset_mock()
@@ -143,10 +201,10 @@ class RestoreMachineTestCase(unittest.TestCase):
         restorer.start()
         time.sleep(1)
         restorer.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        tasks = self.pending_restores()
         self.assertEqual(log.info.call_args_list, [call("Machine 4 restored")])
         self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.5.5.5', timeout=600)])
-        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'], tasks)
+        self.assertListEqual(['10.2.2.2', '10.3.3.3', '10.4.4.4'], tasks)
         log.reset_mock()
         nginx.reset_mock()
         redis.StrictRedis().delete("restore_machine:test_rpaas_machine_restore:last_run")
@@ -156,7 +214,7 @@ class RestoreMachineTestCase(unittest.TestCase):
             restorer.start()
             time.sleep(1)
             restorer.stop()
-            tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+            tasks = self.pending_restores()
             self.assertEqual(log.info.call_args_list, [call("Machine 1 restored"), call("Machine 2 restored"),
                                                        call("Machine 3 restored")])
             nginx_expected_calls = [call('10.2.2.2', timeout=600),
@@ -175,9 +233,9 @@ class RestoreMachineTestCase(unittest.TestCase):
         restorer.start()
         time.sleep(1)
         restorer.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(['restore_10.1.1.1', 'restore_10.2.2.2', 'restore_10.3.3.3',
-                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.1.1.1', '10.2.2.2', '10.3.3.3',
+                              '10.4.4.4', '10.5.5.5'], tasks)
         self.assertEqual(log.info.call_args_list, [])
         self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [])
         redis_lock.release()
@@ -197,8 +255,8 @@ class RestoreMachineTestCase(unittest.TestCase):
         nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
                                 call('10.4.4.4', timeout=600), call('10.5.5.5', timeout=600)]
         self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(tasks, ['restore_10.2.2.2'])
+        tasks = self.pending_restores()
+        self.assertListEqual(tasks, ['10.2.2.2'])
         self.assertTrue(redis_lock.acquire(blocking=False))
         redis_lock.release()
 
@@ -215,9 +273,9 @@ class RestoreMachineTestCase(unittest.TestCase):
         restorer.start()
         time.sleep(1)
         restorer.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3',
-                              'restore_10.4.4.4', 'restore_10.5.5.5'], tasks)
+        tasks = self.pending_restores()
+        self.assertListEqual(['10.2.2.2', '10.3.3.3',
+                              '10.4.4.4', '10.5.5.5'], tasks)
         self.assertEqual(log.info.call_args_list, [call("Machine 0 restored")])
         self.assertEqual(nginx_manager.wait_healthcheck.call_args_list, [call('10.1.1.1', timeout=600)])
         self.assertTrue(redis_lock.acquire(blocking=False))
@@ -247,10 +305,7 @@ class RestoreMachineTestCase(unittest.TestCase):
             nginx_expected_calls = [call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
                                     call('10.4.4.4', timeout=600), call('10.5.5.5', timeout=600)]
             self.assertEqual(nginx_expected_calls, nginx_manager.wait_healthcheck.call_args_list)
-            tasks_restore = []
-            for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}}):
-                tasks_restore.append(task['_id'])
-            self.assertListEqual(tasks_restore, ['restore_10.2.2.2'])
+            self.assertListEqual(self.pending_restores(), ['10.2.2.2'])
 
     @patch.object(tasks.lock.Lock, "extend_lock")
     @patch("rpaas.tasks.nginx")
@@ -324,9 +379,14 @@ class CheckMachineTestCase(unittest.TestCase):
         redis.StrictRedis().delete("check_machine:test_rpaas_check_machine:last_run")
 
     def tearDown(self):
-        self.storage.db[self.storage.tasks_collection].remove()
+        self.storage.db[self.storage.restore_queue_collection].remove()
         self.storage.db[self.storage.hosts_collection].remove()
 
+    def pending_restores(self):
+        restores = self.storage.db[self.storage.restore_queue_collection].find(
+            {"state": {"$ne": storage.RESTORE_DONE}}).sort("_id", 1)
+        return [restore['_id'] for restore in restores]
+
     @patch.object(consul_manager.ConsulManager, "service_healthcheck")
     def test_check_machine_instance_failures(self, service_healthcheck):
         healthcheck = [{'Node': {'Address': '10.1.1.1'},
@@ -353,13 +413,87 @@ class CheckMachineTestCase(unittest.TestCase):
         checker.start()
         time.sleep(1)
         checker.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
-        self.assertListEqual(tasks, ['restore_10.1.1.1', 'restore_10.3.3.3'])
+        tasks = self.pending_restores()
+        self.assertListEqual(tasks, ['10.1.1.1', '10.3.3.3'])
+
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_updates_pending_tasks(self, service_healthcheck):
+        created = datetime.datetime(2016, 2, 3, 11, 0, 0)
+        self.storage.sync_restores([("10.1.1.1", "rpaas_01"), ("10.2.2.2", "rpaas_02")], created=created)
+        healthcheck = [{'Node': {'Address': '10.1.1.1'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_01']}},
+                       {'Node': {'Address': '10.2.2.2'},
+                        'Checks': [{'CheckId': 1, 'Status': 'passing'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_02']}},
+                       {'Node': {'Address': '10.3.3.3'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_02']}}]
+        service_healthcheck.return_value = healthcheck
+        checker = healing.CheckMachine(self.config)
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+        tasks = list(self.storage.db[self.storage.restore_queue_collection].find().sort("_id", 1))
+        self.assertListEqual([task['_id'] for task in tasks], ['10.1.1.1', '10.3.3.3'])
+        self.assertEqual(tasks[0]['created'], created)
+        self.assertEqual(tasks[1]['host'], '10.3.3.3')
+        self.assertEqual(tasks[1]['instance'], 'rpaas_02')
+
+    @patch.object(consul_manager.ConsulManager, "watch_critical_checks")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_watch(self, service_healthcheck, watch_service_health, watch_critical_checks):
+        self.config['CHECK_MACHINE_WATCH'] = "1"
+        healthcheck = [{'Node': {'Address': '10.1.1.1'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_01']}}]
+        service_healthcheck.return_value = healthcheck
+
+        def blocking_query(index=None, wait=None):
+            time.sleep(0.1)
+            return "10", []
+        watch_service_health.side_effect = blocking_query
+        watch_critical_checks.side_effect = blocking_query
+        conn = redis.StrictRedis()
+        for key in conn.keys("check_machine:test_rpaas_check_machine:last_run:*"):
+            conn.delete(key)
+        checker = healing.CheckMachine(self.config)
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+        self.assertEqual(watch_service_health.call_args_list[:2], [call(index=None, wait="5m"),
+                                                                   call(index="10", wait="5m")])
+        self.assertEqual(watch_critical_checks.call_args_list[:2], [call(index=None, wait="5m"),
+                                                                    call(index="10", wait="5m")])
+        self.assertLessEqual(service_healthcheck.call_count, 2)
+        tasks = self.pending_restores()
+        self.assertListEqual(tasks, ['10.1.1.1'])
+
+    @patch.object(consul_manager.ConsulManager, "watch_critical_checks")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_watch_keeps_periodic_check(self, service_healthcheck, watch_service_health,
+                                                      watch_critical_checks):
+        self.config['CHECK_MACHINE_WATCH'] = "1"
+        self.config['CHECK_MACHINE_WATCH_RETRY_INTERVAL'] = "1"
+        healthcheck = [{'Node': {'Address': '10.1.1.1'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_01']}}]
+        service_healthcheck.return_value = healthcheck
+        watch_service_health.side_effect = Exception("consul is down")
+        watch_critical_checks.side_effect = Exception("consul is down")
+        checker = healing.CheckMachine(self.config)
+        checker.start()
+        time.sleep(1)
+        checker.stop()
+        self.assertEqual(service_healthcheck.call_count, 1)
+        self.assertListEqual(self.pending_restores(), ['10.1.1.1'])
 
     def test_check_machine_empty_healthcheck(self):
         checker = healing.CheckMachine(self.config)
         checker.start()
         time.sleep(1)
         checker.stop()
-        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        tasks = self.pending_restores()
         self.assertListEqual(tasks, [])
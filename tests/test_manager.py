@@ -4,6 +4,10 @@
 
 import copy
 import consul
+import json
+import tempfile
+import threading
+import time
 import unittest
 import os
 
@@ -11,8 +15,9 @@ import mock
 
 import rpaas.manager
 from rpaas.manager import Manager, ScaleError, QuotaExceededError
-from rpaas import tasks, storage, nginx
+from rpaas import cache, tasks, storage, nginx
 from rpaas.consul_manager import InstanceAlreadySwappedError, CertificateNotFoundError
+from rpaas.misc import DeadlineExceededError
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
 
@@ -28,6 +33,7 @@ class ManagerTestCase(unittest.TestCase):
         self.storage = storage.MongoDBStorage()
         self.consul = consul.Consul(token=self.master_token)
         self.consul.kv.delete("test-suite-rpaas", recurse=True)
+        cache.load_balancers.clear()
 
         colls = self.storage.db.collection_names(False)
         for coll in colls:
@@ -281,6 +287,17 @@ class ManagerTestCase(unittest.TestCase):
             manager.new_instance("x")
         LoadBalancer.find.assert_called_once_with("x")
 
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_new_instance_error_releases_quota(self, LoadBalancer):
+        LoadBalancer.find.return_value = None
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.side_effect = Exception("consul is down")
+        with self.assertRaises(Exception):
+            manager.new_instance("x", "myteam")
+        self.assertEqual([], self.storage.find_team_quota("myteam")[0])
+        self.assertIsNone(self.storage.find_instance_metadata("x"))
+
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_update_instance(self, LoadBalancer):
         self.storage.db[self.storage.plans_collection].insert(
@@ -357,6 +374,7 @@ class ManagerTestCase(unittest.TestCase):
         lb.destroy.assert_called_once()
         self.assertEquals(self.storage.find_task("x").count(), 0)
         self.assertIsNone(self.storage.find_instance_metadata("x"))
+        self.assertIsNone(self.storage.find_lb_stamp("x"))
         self.assertEquals([cert for cert in self.storage.find_le_certificates({"name": "x"})], [])
         self.assertEquals([cert['name'] for cert in self.storage.find_le_certificates({"name": "y"})][0], "y")
         destroy_token.assert_called_with("abc-123")
@@ -392,6 +410,57 @@ class ManagerTestCase(unittest.TestCase):
         manager.remove_instance("x")
         self.assertEquals(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.tasks.consul_manager")
+    def test_remove_instance_tears_hosts_down_concurrently(self, consul_manager):
+        consul = consul_manager.ConsulManager.return_value
+        consul.node_hostname.side_effect = lambda address: "node-" + address
+        self.storage.store_instance_metadata("x", plan_name="small")
+        lb = self.LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.{}".format(idx), id=str(idx)) for idx in range(1, 4)]
+        started = threading.Event()
+        destroying = []
+
+        def destroy(host):
+            def destroy_host():
+                destroying.append(host.dns_name)
+                if len(destroying) == 3:
+                    started.set()
+                started.wait(5)
+                if host.dns_name == "10.0.0.2":
+                    raise Exception("cloud api error")
+            return destroy_host
+
+        for host in lb.hosts:
+            host.destroy.side_effect = destroy(host)
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.remove_instance("x")
+        self.assertTrue(started.is_set())
+        self.assertEqual(2, lb.remove_host.call_count)
+        self.assertEqual(sorted(consul.remove_node_keys.call_args_list),
+                         [mock.call("x", "node-10.0.0.1", "1"), mock.call("x", "node-10.0.0.3", "3")])
+        self.assertEqual(sorted(consul.leave_node.call_args_list),
+                         [mock.call("node-10.0.0.1"), mock.call("node-10.0.0.3")])
+        consul.transaction.assert_called_once_with()
+        self.assertEquals(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.consul_manager")
+    def test_remove_instance_cleans_consul_keys_when_force_leave_fails(self, consul_manager):
+        consul = consul_manager.ConsulManager.return_value
+        consul.node_hostname.side_effect = lambda address: "node-" + address
+        consul.leave_node.side_effect = [Exception("agent unreachable"), None]
+        self.storage.store_instance_metadata("x", plan_name="small")
+        lb = self.LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.{}".format(idx), id=str(idx)) for idx in range(1, 3)]
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.remove_instance("x")
+        self.assertEqual(sorted(consul.remove_node_keys.call_args_list),
+                         [mock.call("x", "node-10.0.0.1", "1"), mock.call("x", "node-10.0.0.2", "2")])
+        self.assertEqual(2, consul.leave_node.call_count)
+        consul.destroy_instance.assert_called_once_with("x")
+        lb.destroy.assert_called_once_with()
+
     def test_remove_instance_on_swap_error(self):
         self.storage.store_instance_metadata("x", plan_name="small")
         manager = Manager(self.config)
@@ -412,6 +481,15 @@ class ManagerTestCase(unittest.TestCase):
         with self.assertRaises(QuotaExceededError):
             manager.new_instance("g")
 
+    @mock.patch("rpaas.tasks.nginx")
+    def test_remove_instance_releases_team_quota(self, nginx):
+        manager = Manager(self.config)
+        manager.new_instance("x", "myteam")
+        self.assertEqual("myteam", manager.storage.find_instance_metadata("x")["team"])
+        self.assertEqual(["x"], manager.storage.find_team_quota("myteam")[0])
+        manager.remove_instance("x")
+        self.assertEqual([], manager.storage.find_team_quota("myteam")[0])
+
     @mock.patch("rpaas.tasks.nginx")
     def test_remove_instance_do_not_remove_similar_instance_name(self, nginx):
         manager = Manager(self.config)
@@ -432,8 +510,12 @@ class ManagerTestCase(unittest.TestCase):
                                                                "manager": "fake", "group": "foo",
                                                                "alternative_id": 0})
         manager.restore_machine_instance('foo', '10.1.1.1')
-        task = self.storage.find_task("restore_10.1.1.1")
-        self.assertEqual(task[0]['host'], "10.1.1.1")
+        restore = self.storage.find_restore("10.1.1.1")
+        self.assertEqual(restore['host'], "10.1.1.1")
+        self.assertEqual(restore['instance'], "foo")
+        self.assertEqual(restore['state'], "pending")
+        with self.assertRaises(rpaas.tasks.NotReadyError):
+            manager.restore_machine_instance('foo', '10.1.1.1')
 
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_restore_machine_invalid_dns_name(self, LoadBalancer):
@@ -446,10 +528,9 @@ class ManagerTestCase(unittest.TestCase):
 
     def test_restore_machine_instance_cancel(self):
         manager = Manager(self.config)
-        self.storage.store_task("restore_10.1.1.1")
+        self.storage.sync_restores([("10.1.1.1", "foo")])
         manager.restore_machine_instance('foo', '10.1.1.1', True)
-        task = self.storage.find_task("restore_10.1.1.1")
-        self.assertEquals(task.count(), 0)
+        self.assertIsNone(self.storage.find_restore("10.1.1.1"))
 
     def test_restore_machine_instance_cancel_invalid_task(self):
         manager = Manager(self.config)
@@ -554,6 +635,57 @@ class ManagerTestCase(unittest.TestCase):
                                       {'CLOUDSTACK_TEMPLATE_ID': u'1234', 'HOST_TAGS': u'a:b,c:d'})
         self.assertEqual(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.manager.nginx")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_restore_instance_rolling(self, LoadBalancer, nginx):
+        self.config["RPAAS_RESTORE_DELAY"] = 0
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.{}".format(idx), id="h{}".format(idx)) for idx in range(1, 6)]
+        restoring = []
+        two_running = threading.Event()
+
+        def wait_healthcheck(host, timeout, manage_healthcheck):
+            restoring.append(host)
+            if len(restoring) == 2:
+                two_running.set()
+            two_running.wait(5)
+            if host == "10.0.0.3":
+                raise Exception("timeout to response")
+            if host == "10.0.0.4":
+                time.sleep(1.5)
+
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        manager = Manager(self.config)
+        responses = [response for response in manager.restore_instance("x", "50%")]
+        while "." in responses:
+            responses.remove(".")
+        self.assertTrue(two_running.is_set())
+        self.assertEqual(responses[:2], ["Restoring host (1/5) h1\n", "Restoring host (2/5) h2\n"])
+        self.assertIn("host h3: failed to restore - 'timeout to response'\n", responses)
+        self.assertIn("host h1: successfully restored\n", responses)
+        self.assertIn("host h2: successfully restored\n", responses)
+        self.assertIn("host h4: successfully restored\n", responses)
+        self.assertEqual(responses[-1], "restore stopped, 1 hosts not restored\n")
+        self.assertFalse(lb.hosts[4].stop.called)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    def test_restore_window(self):
+        manager = Manager(self.config)
+        self.assertEqual(manager._restore_window(1, 10), 1)
+        self.assertEqual(manager._restore_window("3", 10), 3)
+        self.assertEqual(manager._restore_window("25%", 10), 2)
+        self.assertEqual(manager._restore_window("5%", 10), 1)
+        self.assertEqual(manager._restore_window("100%", 10), 9)
+        self.assertEqual(manager._restore_window("4", 2), 1)
+
+    def test_parse_max_unavailable(self):
+        self.assertEqual((3, False), rpaas.manager.parse_max_unavailable("3"))
+        self.assertEqual((3, False), rpaas.manager.parse_max_unavailable(3))
+        self.assertEqual((25, True), rpaas.manager.parse_max_unavailable(" 25% "))
+        for value in ["abc", "12.5%", "0", "-2", "0%", "150%", ""]:
+            with self.assertRaises(ValueError):
+                rpaas.manager.parse_max_unavailable(value)
+
     @mock.patch("rpaas.manager.nginx")
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_restore_instance_service_instance_not_found(self, LoadBalancer, nginx):
@@ -696,16 +828,16 @@ content = location /x {
         for idx, host in enumerate(hosts):
             host.dns_name = "10.0.0.{}".format(idx + 1)
         self.Host.create.side_effect = hosts
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.wait_healthcheck_many.side_effect = lambda hosts, timeout: [(host, None) for host in hosts]
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
         self.assertEqual(self.Host.create.call_count, 3)
         lb.add_host.assert_has_calls([mock.call(host) for host in hosts])
         self.assertEqual(lb.add_host.call_count, 3)
-        nginx_manager = nginx.Nginx.return_value
-        expected_calls = [mock.call("10.0.0.1", timeout=600),
-                          mock.call("10.0.0.2", timeout=600),
-                          mock.call("10.0.0.3", timeout=600)]
-        self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        nginx_manager.wait_healthcheck_many.assert_called_once_with(["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                                                                    timeout=600)
+        nginx_manager.wait_healthcheck.assert_not_called()
         acls = manager.consul_manager.find_acl_network("x")
         expected_acls = [{'destination': ['192.168.0.0/24'], 'source': '10.0.0.1/32'},
                          {'destination': ['192.168.0.0/24'], 'source': '10.0.0.2/32'},
@@ -724,17 +856,15 @@ content = location /x {
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
         manager.consul_manager.generate_token.return_value = "abc-123"
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.wait_healthcheck_many.side_effect = lambda hosts, timeout: [(host, None) for host in hosts]
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
         self.assertEqual(self.Host.create.call_count, 3)
         lb.add_host.assert_called_with(self.Host.create.return_value)
         self.assertEqual(lb.add_host.call_count, 3)
-        nginx_manager = nginx.Nginx.return_value
         created_host = self.Host.create.return_value
-        expected_calls = [mock.call(created_host.dns_name, timeout=600),
-                          mock.call(created_host.dns_name, timeout=600),
-                          mock.call(created_host.dns_name, timeout=600)]
-        self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        nginx_manager.wait_healthcheck_many.assert_called_once_with([created_host.dns_name] * 3, timeout=600)
 
     @mock.patch("rpaas.tasks.nginx")
     def test_scale_instance_up_with_plan_and_flavor(self, nginx):
@@ -750,17 +880,71 @@ content = location /x {
         config.update(self.flavor["config"])
         config["HOST_TAGS"] = "rpaas_service:test-suite-rpaas,rpaas_instance:x,consul_token:abc-123"
         manager = Manager(self.config)
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.wait_healthcheck_many.side_effect = lambda hosts, timeout: [(host, None) for host in hosts]
         manager.scale_instance("x", 5)
         self.Host.create.assert_called_with("my-host-manager", "x", config)
         self.assertEqual(self.Host.create.call_count, 3)
         lb.add_host.assert_called_with(self.Host.create.return_value)
         self.assertEqual(lb.add_host.call_count, 3)
-        nginx_manager = nginx.Nginx.return_value
         created_host = self.Host.create.return_value
-        expected_calls = [mock.call(created_host.dns_name, timeout=600),
-                          mock.call(created_host.dns_name, timeout=600),
-                          mock.call(created_host.dns_name, timeout=600)]
-        self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        nginx_manager.wait_healthcheck_many.assert_called_once_with([created_host.dns_name] * 3, timeout=600)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_keeps_hosts_healthy_before_stragglers(self, nginx, hc):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        config = copy.deepcopy(self.config)
+        config["RPAAS_SCALE_CONCURRENCY"] = "3"
+        hosts = [mock.Mock(dns_name="10.0.0.{}".format(idx)) for idx in range(1, 4)]
+        self.Host.create.side_effect = hosts
+        nginx.Nginx.return_value.wait_healthcheck_many.return_value = [
+            ("10.0.0.3", None),
+            ("10.0.0.1", None),
+            ("10.0.0.2", Exception("nginx not healthy")),
+        ]
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        manager.scale_instance("x", 5)
+        self.assertEqual(self.Host.create.call_count, 3)
+        self.assertEqual(lb.add_host.call_count, 3)
+        self.assertEqual(hc.return_value.add_url.call_args_list,
+                         [mock.call("x", "10.0.0.3"), mock.call("x", "10.0.0.1")])
+        for host in hosts:
+            self.assertFalse(host.destroy.called)
+        lb.remove_host.assert_not_called()
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_rolls_back_stragglers(self, nginx, hc):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ROLLBACK_ON_ERROR"] = "1"
+        hosts = [mock.Mock(dns_name="10.0.0.{}".format(idx)) for idx in range(1, 4)]
+        self.Host.create.side_effect = hosts
+        nginx.Nginx.return_value.wait_healthcheck_many.return_value = [
+            ("10.0.0.1", None),
+            ("10.0.0.3", None),
+            ("10.0.0.2", DeadlineExceededError("deadline of 604.0s exceeded")),
+        ]
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        manager.scale_instance("x", 5)
+        self.assertEqual(hc.return_value.add_url.call_args_list,
+                         [mock.call("x", "10.0.0.1"), mock.call("x", "10.0.0.3")])
+        hosts[1].destroy.assert_called_once_with()
+        lb.remove_host.assert_called_once_with(hosts[1])
+        hc.return_value.remove_url.assert_called_once_with("x", "10.0.0.2")
+        self.assertFalse(hosts[0].destroy.called)
+        self.assertFalse(hosts[2].destroy.called)
 
     def test_scale_instance_error_task_running(self):
         self.storage.store_task("x")
@@ -944,6 +1128,21 @@ content = location /x {
         manager.consul_manager.remove_server_upstream.assert_called_once_with("inst", "rpaas_default_upstream",
                                                                               "app.host.com")
 
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_unbind_instance_releases_app_host_upstream(self, LoadBalancer):
+        self.storage.store_binding("inst", "app.host.com")
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.unbind("inst")
+        manager.add_route("inst", "/somewhere", "app.host.com", None)
+        manager.consul_manager.reset_mock()
+        manager.delete_route("inst", "/somewhere")
+        manager.consul_manager.remove_server_upstream.assert_called_once_with("inst", "app.host.com",
+                                                                              "app.host.com")
+        manager.consul_manager.remove_location.assert_called_once_with("inst", "/somewhere")
+
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_update_certificate(self, LoadBalancer):
         lb = LoadBalancer.find.return_value
@@ -1277,6 +1476,15 @@ content = location /x {
         manager.acl_manager.add_acl.assert_called_once_with('inst', '10.0.0.1', '192.168.0.1')
         manager.consul_manager.add_server_upstream.assert_called_once_with('inst', 'my_upstream', ['192.168.0.1'])
 
+    @mock.patch("rpaas.acl.AclManager")
+    def test_manager_settings_come_from_config(self, AclManager):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_SERVICE_NAME"] = "other-rpaas"
+        config["CHECK_ACL_API"] = "1"
+        manager = Manager(config)
+        self.assertEqual("other-rpaas", manager.service_name)
+        self.assertIs(AclManager.return_value, manager.acl_manager)
+
     def test_delete_route_error_task_running(self):
         self.storage.store_task("inst")
         manager = Manager(self.config)
@@ -1368,18 +1576,69 @@ content = location /x {
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_purge_location(self, LoadBalancer):
         lb = LoadBalancer.find.return_value
-        lb.hosts = [mock.Mock(), mock.Mock()]
+        lb.hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2")]
+
+        def purge_variant(host, variant):
+            return host == "10.0.0.1" or variant[0] == "gzip"
 
         manager = Manager(self.config)
         manager.nginx_manager = mock.Mock()
-        manager.nginx_manager.purge_location.side_effect = [True, True]
-        purged_hosts = manager.purge_location("inst", "/foo/bar", True)
+        manager.nginx_manager.purge_variants.return_value = nginx.Nginx().purge_variants("/foo/bar", True)
+        manager.nginx_manager.purge_variant.side_effect = purge_variant
+        results = manager.purge_location("inst", "/foo/bar", True)
 
         LoadBalancer.find.assert_called_with("inst")
+        manager.nginx_manager.purge_variants.assert_called_once_with("/foo/bar", True)
+        self.assertEqual(manager.nginx_manager.purge_variant.call_count, 4)
+        self.assertEqual(results, {"10.0.0.1": {"gzip": "purged", "identity": "purged"},
+                                   "10.0.0.2": {"gzip": "purged", "identity": "not purged"}})
 
-        self.assertEqual(purged_hosts, 2)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[0].dns_name, "/foo/bar", True)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[1].dns_name, "/foo/bar", True)
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_location_slow_host_times_out(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2")]
+        config = copy.deepcopy(self.config)
+        config["RPAAS_PURGE_TIMEOUT"] = "1"
+        stuck = threading.Event()
+
+        def purge_variant(host, variant):
+            if host == "10.0.0.2":
+                stuck.wait(5)
+            return True
+
+        manager = Manager(config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.return_value = nginx.Nginx().purge_variants("/foo/bar")
+        manager.nginx_manager.purge_variant.side_effect = purge_variant
+        results = manager.purge_location("inst", "/foo/bar")
+        stuck.set()
+        self.assertEqual(results["10.0.0.1"], {"http/gzip": "purged", "http/identity": "purged",
+                                               "https/gzip": "purged", "https/identity": "purged"})
+        self.assertEqual(set(results["10.0.0.2"].values()), set(["timeout"]))
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_locations(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2")]
+
+        def purge_batch(host, variants, deadline):
+            if host == "10.0.0.2":
+                return [True] + [None] * (len(variants) - 1)
+            return [True] * len(variants)
+
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.side_effect = nginx.Nginx().purge_variants
+        manager.nginx_manager.purge_batch.side_effect = purge_batch
+        results = manager.purge_locations("inst", ["/a", " /b ", "/a"], True)
+
+        LoadBalancer.find.assert_called_once_with("inst")
+        self.assertEqual(manager.nginx_manager.purge_batch.call_count, 2)
+        _, variants, _ = manager.nginx_manager.purge_batch.call_args[0]
+        self.assertEqual([v[1] for v in variants], ["purge//a", "purge//a", "purge/ /b ", "purge/ /b "])
+        self.assertEqual(results["/a"], {"10.0.0.1": {"gzip": "purged", "identity": "purged"},
+                                         "10.0.0.2": {"gzip": "purged", "identity": "timeout"}})
+        self.assertEqual(results[" /b "]["10.0.0.2"], {"gzip": "timeout", "identity": "timeout"})
 
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_add_lua_with_content(self, LoadBalancer):
@@ -1436,3 +1695,100 @@ content = location /x {
         manager.consul_manager = mock.Mock()
         with self.assertRaises(storage.InstanceNotFoundError):
             manager.swap("x", "y")
+
+    def test_get_manager_is_shared_until_reloaded(self):
+        rpaas.close_manager()
+        manager = rpaas.get_manager()
+        self.assertIs(manager, rpaas.get_manager())
+        reloaded = rpaas.reload_manager()
+        self.assertIsNot(manager, reloaded)
+        self.assertIs(reloaded, rpaas.get_manager())
+        rpaas.close_manager()
+        self.assertIsNot(reloaded, rpaas.get_manager())
+
+    @mock.patch.dict(os.environ, {"RPAAS_CONFIG_CHECK_INTERVAL": "0"})
+    def test_get_manager_reloads_when_config_file_changes(self):
+        config_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        self.addCleanup(os.remove, config_file.name)
+        json.dump({"RPAAS_HEALTHCHECK_TIMEOUT": "60"}, config_file)
+        config_file.close()
+        os.environ["RPAAS_CONFIG_FILE"] = config_file.name
+        rpaas.close_manager()
+        self.addCleanup(rpaas.close_manager)
+        manager = rpaas.get_manager()
+        self.assertEqual("60", manager.config["RPAAS_HEALTHCHECK_TIMEOUT"])
+        self.assertIs(manager, rpaas.get_manager())
+        with open(config_file.name, "w") as f:
+            json.dump({"RPAAS_HEALTHCHECK_TIMEOUT": "120"}, f)
+        mtime = os.stat(config_file.name).st_mtime + 10
+        os.utime(config_file.name, (mtime, mtime))
+        reloaded = rpaas.get_manager()
+        self.assertIsNot(manager, reloaded)
+        self.assertEqual("120", reloaded.config["RPAAS_HEALTHCHECK_TIMEOUT"])
+        with open(config_file.name, "w") as f:
+            f.write("{broken")
+        os.utime(config_file.name, (mtime + 10, mtime + 10))
+        self.assertIs(reloaded, rpaas.get_manager())
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_migrate_upstreams(self, LoadBalancer):
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.migrate_upstreams.return_value = ["inst"]
+        self.assertEqual(["inst"], manager.migrate_upstreams("inst"))
+        manager.consul_manager.migrate_upstreams.assert_called_once_with("inst")
+        LoadBalancer.find.return_value = None
+        with self.assertRaises(storage.InstanceNotFoundError):
+            manager.migrate_upstreams("other")
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_lookups_are_cached(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.0.0.1")]
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.bind("inst", "app.host.com", router_mode=True)
+        manager.add_upstream("inst", "inst", ["10.1.1.1:8080"])
+        manager.list_upstreams("inst", "inst")
+        LoadBalancer.find.assert_called_once_with("inst")
+        self.assertEqual(cache.load_balancers.stats(),
+                         {"size": 1, "hits": 2, "misses": 1, "invalidations": 0})
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_not_found_is_not_cached(self, LoadBalancer):
+        LoadBalancer.find.return_value = None
+        manager = Manager(self.config)
+        with self.assertRaises(storage.InstanceNotFoundError):
+            manager.list_upstreams("inst", "inst")
+        LoadBalancer.find.return_value = mock.Mock(hosts=[])
+        manager.consul_manager = mock.Mock()
+        manager.list_upstreams("inst", "inst")
+        self.assertEqual(LoadBalancer.find.call_count, 2)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_dropped_on_stamp_change(self, LoadBalancer):
+        LoadBalancer.find.return_value = mock.Mock(hosts=[])
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.list_upstreams("inst", "inst")
+        manager.list_upstreams("inst", "inst")
+        self.assertEqual(LoadBalancer.find.call_count, 1)
+        self.storage.bump_lb_stamp("inst")
+        manager.list_upstreams("inst", "inst")
+        manager.list_upstreams("inst", "inst")
+        self.assertEqual(LoadBalancer.find.call_count, 2)
+        self.assertEqual(1, cache.load_balancers.stats()["invalidations"])
+        self.storage.remove_lb_stamp("inst")
+        self.assertIsNone(self.storage.find_lb_stamp("inst"))
+        manager.list_upstreams("inst", "inst")
+        self.assertEqual(LoadBalancer.find.call_count, 3)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_load_balancer_cache_expires(self, LoadBalancer):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_LB_CACHE_TTL"] = "0"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.list_upstreams("inst", "inst")
+        manager.list_upstreams("inst", "inst")
+        self.assertEqual(LoadBalancer.find.call_count, 2)
@@ -2,16 +2,20 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import time
 import unittest
 
 import mock
+from requests import exceptions as requests_exceptions
 
-from rpaas.nginx import Nginx, NginxError
+from rpaas import nginx as nginx_module
+from rpaas.nginx import Nginx, NginxError, ConfigManager, LocationTemplate
 
 
 class NginxTestCase(unittest.TestCase):
 
     def setUp(self):
+        nginx_module.location_templates.clear()
         self.cache_headers = [{'Accept-Encoding': 'gzip'}, {'Accept-Encoding': 'identity'}]
 
     def test_init_default(self):
@@ -41,6 +45,7 @@ class NginxTestCase(unittest.TestCase):
                 def __init__(self, text, status_code):
                     self.text = text
                     self.status_code = status_code
+                    self.headers = {}
             if args[0] == 'http://my.com/default':
                 return MockResponse("my result default", 200)
             elif args[0] == 'http://my.com/router':
@@ -53,10 +58,74 @@ class NginxTestCase(unittest.TestCase):
             })
         self.assertEqual(nginx.config_manager.location_template_default, 'my result default')
         self.assertEqual(nginx.config_manager.location_template_router, 'my result router')
-        expected_calls = [mock.call('http://my.com/default'),
-                          mock.call('http://my.com/router')]
+        expected_calls = [mock.call('http://my.com/default', headers={}, timeout=10),
+                          mock.call('http://my.com/router', headers={}, timeout=10)]
         requests_get.assert_has_calls(expected_calls)
 
+    @mock.patch('rpaas.nginx.requests')
+    def test_location_template_url_is_cached(self, requests):
+        response = mock.Mock(status_code=200, text="location {path} {{ proxy_pass http://{upstream}; }}",
+                             headers={"ETag": "v1"})
+        requests.get.return_value = response
+        conf = {'NGINX_LOCATION_TEMPLATE_ROUTER_URL': 'http://my.com/router'}
+        ConfigManager(conf)
+        manager = ConfigManager(conf)
+        self.assertEqual(requests.get.call_count, 1)
+        self.assertEqual(manager.generate_host_config("/app", "app.host", "up", router_mode=True),
+                         "location /app/ { proxy_pass http://up; }")
+
+    @mock.patch('rpaas.nginx.threading')
+    @mock.patch('rpaas.nginx.requests')
+    def test_location_template_url_stale_while_revalidate(self, requests, threading):
+        threading.Lock.return_value = mock.MagicMock()
+        requests.get.side_effect = [
+            mock.Mock(status_code=200, text="old {path}", headers={"ETag": "v1", "Last-Modified": "yesterday"}),
+            mock.Mock(status_code=304, text="", headers={}),
+            mock.Mock(status_code=200, text="new {path}", headers={"ETag": "v2"}),
+        ]
+        cache = nginx_module.TemplateCache()
+        self.assertEqual(cache.get("http://my.com/t", 60, 5).text, "old {path}")
+        cache.entries["http://my.com/t"]["fetched_at"] = time.time() - 120
+        self.assertEqual(cache.get("http://my.com/t", 60, 5).text, "old {path}")
+        _, kwargs = threading.Thread.call_args
+        kwargs["target"](*kwargs["args"])
+        requests.get.assert_called_with("http://my.com/t", timeout=5,
+                                        headers={"If-None-Match": "v1", "If-Modified-Since": "yesterday"})
+        self.assertEqual(cache.get("http://my.com/t", 60, 5).text, "old {path}")
+        cache.entries["http://my.com/t"]["fetched_at"] = time.time() - 120
+        cache.get("http://my.com/t", 60, 5)
+        _, kwargs = threading.Thread.call_args
+        kwargs["target"](*kwargs["args"])
+        self.assertEqual(cache.get("http://my.com/t", 60, 5).text, "new {path}")
+
+    @mock.patch('rpaas.nginx.threading')
+    @mock.patch('rpaas.nginx.requests')
+    def test_location_template_url_revalidation_error_keeps_stale(self, requests, threading):
+        threading.Lock.return_value = mock.MagicMock()
+        requests.get.side_effect = [
+            mock.Mock(status_code=200, text="old {path}", headers={}),
+            Exception("template server down"),
+        ]
+        cache = nginx_module.TemplateCache()
+        cache.get("http://my.com/t", 60, 5)
+        cache.entries["http://my.com/t"]["fetched_at"] = time.time() - 120
+        cache.get("http://my.com/t", 60, 5)
+        _, kwargs = threading.Thread.call_args
+        kwargs["target"](*kwargs["args"])
+        entry = cache.entries["http://my.com/t"]
+        self.assertEqual(entry["template"].text, "old {path}")
+        self.assertFalse(entry["refreshing"])
+        self.assertLess(time.time() - entry["fetched_at"], 60)
+
+    def test_location_template_format(self):
+        template = LocationTemplate("location {path} {{\n    proxy_pass http://{upstream};\n}}")
+        self.assertTrue(template.simple)
+        self.assertEqual(template.format(path="/a/", upstream="up", host="h"),
+                         "location /a/ {\n    proxy_pass http://up;\n}")
+        template = LocationTemplate("location {path!s:>4} {{}}")
+        self.assertFalse(template.simple)
+        self.assertEqual(template.format(path="/a"), "location   /a {}")
+
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_successfully(self, requests):
         nginx = Nginx()
@@ -69,16 +138,16 @@ class NginxTestCase(unittest.TestCase):
         side_effect.status_code = 404
         side_effect.text = "Not Found"
 
-        requests.request.side_effect = [response, side_effect, response, side_effect]
+        requests.Session.return_value.request.side_effect = [response, side_effect, response, side_effect]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(requests.Session.return_value.request.call_count, 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
-                                       headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+                                       headers=header, timeout=(2, 2)))
+        requests.Session.return_value.request.assert_has_calls(expec_responses)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_preserve_path_successfully(self, requests):
@@ -88,15 +157,49 @@ class NginxTestCase(unittest.TestCase):
         response.status_code = 200
         response.text = 'purged'
 
-        requests.request.side_effect = [response]
+        requests.Session.return_value.request.side_effect = [response]
         purged = nginx.purge_location('myhost', 'http://example.com/foo/bar', True)
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 2)
+        self.assertEqual(requests.Session.return_value.request.call_count, 2)
         expected_responses = []
         for header in self.cache_headers:
             expected_responses.append(mock.call('get', 'http://myhost:8089/purge/http://example.com/foo/bar',
-                                      headers=header, timeout=2))
-        requests.request.assert_has_calls(expected_responses)
+                                      headers=header, timeout=(2, 2)))
+        requests.Session.return_value.request.assert_has_calls(expected_responses)
+
+    def test_purge_variants(self):
+        nginx = Nginx()
+        variants = nginx.purge_variants('/foo/bar')
+        self.assertEqual([v[0] for v in variants], ['http/gzip', 'http/identity', 'https/gzip', 'https/identity'])
+        self.assertEqual(variants[2], ('https/gzip', 'purge/https/foo/bar', {'Accept-Encoding': 'gzip'}))
+        variants = nginx.purge_variants('http://example.com/foo', True)
+        self.assertEqual(variants, [('gzip', 'purge/http://example.com/foo', {'Accept-Encoding': 'gzip'}),
+                                    ('identity', 'purge/http://example.com/foo', {'Accept-Encoding': 'identity'})])
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_admin_requests_share_pooled_session(self, requests):
+        nginx = Nginx({'NGINX_CONNECT_TIMEOUT': '1', 'NGINX_READ_TIMEOUT': '5', 'NGINX_POOL_SIZE': '4'})
+        session = requests.Session.return_value
+        session.request.return_value = mock.Mock(status_code=200, text='WORKING')
+        nginx.wait_healthcheck('host-1')
+        nginx.wait_healthcheck('host-2')
+        requests.Session.assert_called_once_with()
+        requests.adapters.HTTPAdapter.assert_called_once_with(pool_connections=100, pool_maxsize=4)
+        session.mount.assert_any_call('https://', requests.adapters.HTTPAdapter.return_value)
+        session.request.assert_called_with('get', 'http://host-2:8089/healthcheck', timeout=(1, 5))
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_purge_batch(self, requests):
+        nginx = Nginx()
+        ok = mock.Mock(status_code=200, text='purged')
+        not_found = mock.Mock(status_code=404, text='Not Found')
+        requests.Session.return_value.request.side_effect = [ok, not_found]
+        variants = nginx.purge_variants('/foo', True) + nginx.purge_variants('/bar', True)
+        results = nginx.purge_batch('myhost', variants[:2])
+        self.assertEqual(results, [True, False])
+        results = nginx.purge_batch('myhost', variants, deadline=time.time() - 1)
+        self.assertEqual(results, [None, None, None, None])
+        self.assertEqual(requests.Session.return_value.request.call_count, 2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_not_found(self, requests):
@@ -106,16 +209,16 @@ class NginxTestCase(unittest.TestCase):
         response.status_code = 404
         response.text = 'Not Found'
 
-        requests.request.side_effect = [response, response, response, response]
+        requests.Session.return_value.request.side_effect = [response, response, response, response]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertFalse(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(requests.Session.return_value.request.call_count, 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
-                                       headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+                                       headers=header, timeout=(2, 2)))
+        requests.Session.return_value.request.assert_has_calls(expec_responses)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck(self, requests):
@@ -128,13 +231,14 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise requests_exceptions.ConnectionError('some error')
             return response
 
-        requests.request.side_effect = side_effect
+        requests.Session.return_value.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertEqual(requests.Session.return_value.request.call_count, 2)
+        requests.Session.return_value.request.assert_called_with(
+            'get', 'http://myhost.com:8089/healthcheck', timeout=(2, 2))
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck(self, requests):
@@ -147,13 +251,14 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise requests_exceptions.ConnectionError('some error')
             return response
 
-        requests.request.side_effect = side_effect
+        requests.Session.return_value.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        self.assertEqual(requests.Session.return_value.request.call_count, 2)
+        requests.Session.return_value.request.assert_called_with(
+            'get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=(2, 2))
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck_invalid_response(self, requests):
@@ -166,27 +271,80 @@ class NginxTestCase(unittest.TestCase):
         def side_effect(method, url, timeout, **params):
             count[0] += 1
             if count[0] < 2:
-                raise Exception('some error')
+                raise requests_exceptions.ConnectionError('some error')
             return response
 
-        requests.request.side_effect = side_effect
-        with self.assertRaises(NginxError):
-            nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 6)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        requests.Session.return_value.request.side_effect = side_effect
+        with mock.patch('rpaas.nginx.random.uniform', side_effect=lambda low, high: high):
+            with self.assertRaises(NginxError):
+                nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
+        # attempts at 0, 0.5, 1.5, 3.5 and at the 5 seconds deadline
+        self.assertEqual(requests.Session.return_value.request.call_count, 5)
+        requests.Session.return_value.request.assert_called_with(
+            'get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=(2, 2))
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck_timeout(self, requests):
         nginx = Nginx()
 
         def side_effect(method, url, timeout, **params):
-            raise Exception('some error')
+            raise requests_exceptions.ConnectionError('some error')
 
-        requests.request.side_effect = side_effect
+        requests.Session.return_value.request.side_effect = side_effect
         with self.assertRaises(Exception):
             nginx.wait_healthcheck('myhost.com', timeout=2)
-        self.assertGreaterEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertGreaterEqual(requests.Session.return_value.request.call_count, 2)
+        requests.Session.return_value.request.assert_called_with(
+            'get', 'http://myhost.com:8089/healthcheck', timeout=(2, 2))
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthcheck_many(self, requests):
+        nginx = Nginx()
+        healthy = mock.Mock(status_code=200, text='WORKING')
+        failing = mock.Mock(status_code=503, text='starting')
+        calls = {}
+
+        def side_effect(method, url, timeout, **params):
+            host = url.split('/')[2].split(':')[0]
+            calls[host] = calls.get(host, 0) + 1
+            if host == 'host-a' or (host == 'host-b' and calls[host] > 1):
+                return healthy
+            return failing
+
+        requests.Session.return_value.request.side_effect = side_effect
+        results = list(nginx.wait_healthcheck_many(['host-c', 'host-b', 'host-a'], timeout=1))
+        self.assertEqual([host for host, _ in results], ['host-a', 'host-b', 'host-c'])
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][1])
+        self.assertIsInstance(results[2][1], NginxError)
+        self.assertEqual(503, results[2][1].status_code)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthcheck_does_not_retry_fatal_errors(self, requests):
+        nginx_module.retry_stats.clear()
+        nginx = Nginx()
+        requests.Session.return_value.request.return_value = mock.Mock(status_code=403, text='forbidden')
+        with self.assertRaises(NginxError) as cm:
+            nginx.wait_healthcheck('myhost.com', timeout=5)
+        self.assertEqual(403, cm.exception.status_code)
+        self.assertEqual(requests.Session.return_value.request.call_count, 1)
+        stats = nginx_module.retry_stats.stats()["wait_healthcheck"]
+        self.assertEqual((1, 1, 1), (stats["calls"], stats["attempts"], stats["failures"]))
+
+    def test_retry_policy_delay(self):
+        policy = nginx_module.RetryPolicy(initial_delay=0.5, max_delay=5)
+        with mock.patch('rpaas.nginx.random.uniform', side_effect=lambda low, high: (low, high)):
+            self.assertEqual([policy.delay(attempt) for attempt in range(6)],
+                             [(0.25, 0.5), (0.5, 1), (1, 2), (2, 4), (2.5, 5), (2.5, 5)])
+        self.assertTrue(policy.retryable(requests_exceptions.ConnectionError('connection refused')))
+        self.assertTrue(policy.retryable(requests_exceptions.ReadTimeout('read timed out')))
+        self.assertFalse(policy.retryable(requests_exceptions.SSLError('certificate verify failed')))
+        self.assertFalse(policy.retryable(requests_exceptions.InvalidURL('invalid url')))
+        self.assertFalse(policy.retryable(ValueError('bug')))
+        self.assertTrue(policy.retryable(NginxError('error', 502)))
+        self.assertTrue(policy.retryable(NginxError('error', 404)))
+        self.assertFalse(policy.retryable(NginxError('error', 400)))
+        self.assertFalse(policy.retryable(NginxError('CA_CERT should be set')))
 
     @mock.patch('os.path')
     @mock.patch('rpaas.nginx.requests')
@@ -196,10 +354,11 @@ class NginxTestCase(unittest.TestCase):
         response = mock.Mock()
         response.status_code = 200
         response.text = '\n\nticket was succsessfully added'
-        requests.request.return_value = response
+        requests.Session.return_value.request.return_value = response
         nginx.add_session_ticket('host-1', 'random data', timeout=2)
-        requests.request.assert_called_once_with('post', 'https://host-1:8090/session_ticket', timeout=2,
-                                                 data='random data', verify='/tmp/rpaas_ca.pem')
+        requests.Session.return_value.request.assert_called_once_with(
+            'post', 'https://host-1:8090/session_ticket', timeout=(2, 2), data='random data',
+            verify='/tmp/rpaas_ca.pem')
 
     @mock.patch('rpaas.nginx.requests')
     def test_missing_ca_cert(self, requests):
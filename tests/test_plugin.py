@@ -507,6 +507,23 @@ server: server content
         self.assertEqual(request.get_method(), 'POST')
         urlopen.assert_called_with(request)
 
+    @mock.patch("rpaas.plugin.urlopen")
+    @mock.patch("rpaas.plugin.Request")
+    @mock.patch("sys.stdout")
+    @mock.patch("sys.stdin")
+    def test_purge_from_file(self, stdin, stdout, Request, urlopen):
+        request = Request.return_value
+        urlopen.return_value.getcode.return_value = 200
+        stdin.readlines.return_value = ["/foo/bar?a=b\n", "\n", "http://www.example.com/baz\n"]
+        self.set_envs()
+        self.addCleanup(self.delete_envs)
+        plugin.purge(['-s', 'myservice', '-i', 'myinst', '-f', '-'])
+        Request.assert_called_with(self.target +
+                                   "services/myservice/proxy/myinst?" +
+                                   "callback=/resources/myinst/purge/bulk")
+        request.add_data.assert_called_with("path=%2Ffoo%2Fbar%3Fa%3Db&path=%2Fbaz&preserve_path=False")
+        urlopen.assert_called_with(request)
+
     @mock.patch("rpaas.plugin.urlopen")
     @mock.patch("rpaas.plugin.Request")
     @mock.patch("sys.stderr")
@@ -50,6 +50,56 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual(used, q["used"])
         self.assertEqual(quota, q["quota"])
 
+    def test_reserve_quota(self):
+        self.assertEqual((True, [], 5), self.storage.reserve_quota("myteam", "inst1"))
+        self.storage.set_team_quota("myteam", 2)
+        self.assertEqual((True, ["inst1"], 2), self.storage.reserve_quota("myteam", "inst2"))
+        self.assertEqual((False, ["inst1", "inst2"], 2), self.storage.reserve_quota("myteam", "inst3"))
+        self.assertEqual((False, ["inst1", "inst2"], 2), self.storage.reserve_quota("myteam", "inst1"))
+        self.assertEqual((["inst1", "inst2"], 2), self.storage.find_team_quota("myteam"))
+        self.storage.set_team_quota("myteam", 3)
+        self.assertEqual((True, ["inst1", "inst2"], 3), self.storage.reserve_quota("myteam", "inst3"))
+        self.assertEqual(0, self.storage.db[self.storage.quota_collection].find_one({"_id": "myteam"})["remaining"])
+
+    def test_reserve_quota_already_reserved(self):
+        self.storage.reserve_quota("myteam", "inst1")
+        self.assertEqual((True, ["inst1"], 5), self.storage.reserve_quota("myteam", "inst1"))
+        self.assertEqual((["inst1"], 5), self.storage.find_team_quota("myteam"))
+
+    def test_reserve_quota_without_remaining_counter(self):
+        self.storage.db[self.storage.quota_collection].insert({"_id": "myteam", "used": ["inst1"], "quota": 2})
+        self.assertEqual((True, ["inst1"], 2), self.storage.reserve_quota("myteam", "inst2"))
+        self.assertEqual((False, ["inst1", "inst2"], 2), self.storage.reserve_quota("myteam", "inst3"))
+        self.storage.decrement_quota("inst1", "myteam")
+        self.assertEqual(1, self.storage.db[self.storage.quota_collection].find_one({"_id": "myteam"})["remaining"])
+
+    def test_decrement_quota(self):
+        self.storage.reserve_quota("myteam", "inst1")
+        self.storage.reserve_quota("myteam", "inst2")
+        self.storage.reserve_quota("yourteam", "inst3")
+        self.storage.db[self.storage.quota_collection].insert({"_id": "legacyteam", "used": ["inst4"], "quota": 2})
+        self.storage.decrement_quota("inst1", "myteam")
+        self.storage.decrement_quota("inst3")
+        self.storage.decrement_quota("inst2", "yourteam")
+        self.storage.decrement_quota("inst4", "legacyteam")
+        self.storage.decrement_quota("inst4", "legacyteam")
+        self.assertEqual([], self.storage.find_team_quota("myteam")[0])
+        self.assertEqual([], self.storage.find_team_quota("yourteam")[0])
+        self.assertEqual([], self.storage.find_team_quota("legacyteam")[0])
+        quotas = dict((quota["_id"], quota.get("remaining")) for quota in
+                      self.storage.db[self.storage.quota_collection].find())
+        self.assertEqual({"myteam": 5, "yourteam": 5, "legacyteam": None}, quotas)
+
+    def test_backfill_instance_teams(self):
+        self.storage.reserve_quota("myteam", "inst1")
+        self.storage.reserve_quota("myteam", "inst2")
+        self.storage.store_instance_metadata("inst1", plan_name="small")
+        self.storage.store_instance_metadata("inst2", plan_name="small", team="myteam")
+        self.assertEqual(1, self.storage.backfill_instance_teams())
+        self.assertEqual({"_id": "inst1", "plan_name": "small", "team": "myteam"},
+                         self.storage.find_instance_metadata("inst1"))
+        self.assertEqual(0, self.storage.backfill_instance_teams())
+
     def test_list_plans(self):
         plans = self.storage.list_plans()
         expected = [
@@ -118,6 +168,23 @@ class MongoDBStorageTestCase(unittest.TestCase):
         with self.assertRaises(storage.PlanNotFoundError):
             self.storage.delete_plan("super_huge")
 
+    def test_plans_catalog_reloads_on_change_stamp(self):
+        p = plan.Plan(name="super_huge", description="very huge thing",
+                      config={"serviceofferingid": "abcdef123"})
+        self.storage.store_plan(p)
+        self.assertEqual("some cool plan", self.storage.find_plan("small").description)
+        self.storage.db[self.storage.plans_collection].update({"_id": "small"},
+                                                              {"$set": {"description": "changed"}})
+        self.assertEqual("some cool plan", self.storage.find_plan("small").description)
+        self.assertEqual(["small", "huge", "super_huge"], [item.name for item in self.storage.list_plans()])
+        self.storage.update_plan("huge", description="bigger")
+        other_storage = storage.MongoDBStorage()
+        self.assertEqual("changed", other_storage.find_plan("small").description)
+        self.assertEqual("bigger", other_storage.find_plan("huge").description)
+        self.storage.delete_plan("huge")
+        with self.assertRaises(storage.PlanNotFoundError):
+            other_storage.find_plan("huge")
+
     def test_list_flavors(self):
         flavors = self.storage.list_flavors()
         expected = [
@@ -143,6 +210,18 @@ class MongoDBStorageTestCase(unittest.TestCase):
         got_flavor = self.storage.find_flavor(f.name)
         self.assertEqual(f.to_dict(), got_flavor.to_dict())
 
+    def test_flavors_catalog_reloads_on_change_stamp(self):
+        f = flavor.Flavor(name="lemon", description="nginx 1.13",
+                          config={"nginx_version": "1.13"})
+        self.storage.store_flavor(f)
+        self.assertEqual("nginx 1.13", self.storage.find_flavor("lemon").description)
+        self.storage.db[self.storage.flavors_collection].remove({"_id": "lemon"})
+        self.assertEqual("nginx 1.13", self.storage.find_flavor("lemon").description)
+        self.storage.update_flavor("vanilla", description="nginx 1.10.3")
+        with self.assertRaises(storage.FlavorNotFoundError):
+            self.storage.find_flavor("lemon")
+        self.assertEqual("nginx 1.10.3", self.storage.find_flavor("vanilla").description)
+
     def test_store_flavor_duplicate(self):
         f = flavor.Flavor(name="vanilla", description="nginx 1.10",
                           config={"nginx_version": "1.10"})
@@ -270,3 +349,145 @@ class MongoDBStorageTestCase(unittest.TestCase):
         expected.reverse()
         healing_list = self.storage.list_healings(3)
         self.assertListEqual(healing_list, expected)
+
+    def test_storages_share_mongo_client(self):
+        other = storage.MongoDBStorage()
+        self.assertIs(self.storage.db.client, other.db.client)
+        self.assertEqual(self.storage.mongo_database, "storage_test")
+
+    def test_restore_queue(self):
+        storage.indexed.clear()
+        now = datetime.datetime(2016, 2, 3, 12, 0, 0)
+        created = now - datetime.timedelta(minutes=10)
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "foo",
+                                 "created": created})
+        self.storage.ensure_restore_queue()
+        self.assertEqual(0, self.storage.find_task("restore_10.1.1.1").count())
+        indexes = self.storage.db[self.storage.restore_queue_collection].index_information()
+        self.assertEqual(7 * 24 * 3600, indexes["finished_at_1"]["expireAfterSeconds"])
+        self.storage.sync_restores([("10.2.2.2", "foo"), ("10.1.1.1", "bar")], created=created)
+        self.assertEqual({"10.1.1.1": "pending", "10.2.2.2": "pending"},
+                         self.storage.find_restore_states(["10.1.1.1", "10.2.2.2", "10.3.3.3"]))
+        self.assertEqual("foo", self.storage.find_restore("10.1.1.1")["instance"])
+        self.assertEqual(["foo"], self.storage.restore_instances(now, now, now))
+        created_in = now - datetime.timedelta(minutes=5)
+        stale_in = now - datetime.timedelta(hours=1)
+        restore = self.storage.claim_restore(now, created_in, stale_in)
+        self.assertEqual("10.1.1.1", restore["_id"])
+        self.assertEqual("running", restore["state"])
+        next_attempt_at = now + datetime.timedelta(minutes=5)
+        self.storage.postpone_restore(restore, now, next_attempt_at)
+        self.assertIsNone(self.storage.claim_restore(now, created_in, stale_in))
+        self.assertEqual(next_attempt_at, self.storage.find_restore("10.2.2.2")["next_attempt_at"])
+        later = next_attempt_at + datetime.timedelta(minutes=1)
+        restore = self.storage.claim_restore(later, created_in, stale_in, "foo")
+        self.assertEqual("10.1.1.1", restore["_id"])
+        self.storage.finish_restore(restore)
+        self.assertEqual("done", self.storage.find_restore("10.1.1.1")["state"])
+        restore = self.storage.claim_restore(later, created_in, stale_in)
+        self.assertEqual("10.2.2.2", restore["_id"])
+        self.assertIsNone(self.storage.claim_restore(later, created_in, stale_in))
+        reclaimed = self.storage.claim_restore(later, created_in,
+                                               datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+        self.assertEqual("10.2.2.2", reclaimed["_id"])
+        self.assertFalse(self.storage.cancel_restore("10.2.2.2"))
+        self.storage.sync_restores([("10.1.1.1", "bar")], cancel=["10.2.2.2"], created=now)
+        self.assertEqual({"10.1.1.1": "pending", "10.2.2.2": "running"},
+                         self.storage.find_restore_states(["10.1.1.1", "10.2.2.2"]))
+        self.assertEqual("bar", self.storage.find_restore("10.1.1.1")["instance"])
+        self.assertTrue(self.storage.cancel_restore("10.1.1.1"))
+        self.assertIsNone(self.storage.find_restore("10.1.1.1"))
+
+    def test_ensure_restore_queue_keeps_retry_backoff(self):
+        storage.indexed.clear()
+        created = datetime.datetime(2016, 2, 3, 11, 0, 0)
+        last_attempt = datetime.datetime(2016, 2, 3, 12, 0, 0)
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "foo",
+                                 "created": created, "last_attempt": last_attempt})
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "foo",
+                                 "created": created})
+        self.storage.store_task({"_id": "restore_10.3.3.3", "host": "10.3.3.3", "instance": "bar",
+                                 "created": created})
+        self.storage.ensure_restore_queue()
+        next_attempt_at = last_attempt + datetime.timedelta(minutes=5)
+        self.assertEqual(next_attempt_at, self.storage.find_restore("10.1.1.1")["next_attempt_at"])
+        self.assertEqual(next_attempt_at, self.storage.find_restore("10.2.2.2")["next_attempt_at"])
+        self.assertEqual(created, self.storage.find_restore("10.3.3.3")["next_attempt_at"])
+        restore = self.storage.claim_restore(last_attempt, last_attempt, last_attempt)
+        self.assertEqual("10.3.3.3", restore["_id"])
+        self.assertIsNone(self.storage.claim_restore(last_attempt, last_attempt, last_attempt))
+
+    def test_ensure_indexes(self):
+        self.assertIn({"collection": "healing", "keys": [("start_time", -1)]},
+                      self.storage.missing_indexes())
+        self.storage.ensure_indexes()
+        self.assertEqual([], self.storage.missing_indexes())
+        indexes = self.storage.db[self.storage.quota_collection].index_information()
+        self.assertIn("used_1", indexes)
+
+    def test_ensure_indexes_updates_restore_queue_ttl(self):
+        self.storage.ensure_indexes([self.storage.restore_queue_collection])
+        os.environ["RESTORE_QUEUE_TTL"] = "3600"
+        self.addCleanup(os.environ.pop, "RESTORE_QUEUE_TTL")
+        self.storage.ensure_indexes([self.storage.restore_queue_collection])
+        indexes = self.storage.db[self.storage.restore_queue_collection].index_information()
+        self.assertEqual(3600, indexes["finished_at_1"]["expireAfterSeconds"])
+
+    def test_query_plans(self):
+        self.storage.ensure_indexes()
+        plans = dict((p["method"], p) for p in self.storage.query_plans())
+        self.assertItemsEqual(["find_host_id", "list_healings", "find_le_certificates",
+                               "claim_restore", "decrement_quota"], plans.keys())
+        for method, p in plans.items():
+            self.assertNotIn("COLLSCAN", p["stages"], method)
+        self.assertEqual(["created_1"], plans["find_le_certificates"]["indexes"])
+
+    def test_plan_stages(self):
+        plan = {"stage": "FETCH", "inputStage": {"stage": "OR", "inputStages": [
+            {"stage": "IXSCAN", "indexName": "created_1"},
+            {"stage": "IXSCAN", "indexName": "next_attempt_at_1"}]}}
+        stages, indexes = storage._plan_stages(plan)
+        self.assertEqual(["FETCH", "OR", "IXSCAN", "IXSCAN"], stages)
+        self.assertEqual(["created_1", "next_attempt_at_1"], indexes)
+
+    def test_binding_routes(self):
+        self.storage.store_binding("inst", "app.host.com")
+        self.storage.replace_binding_path("inst", "/a.b", "dune.com")
+        self.storage.replace_binding_path("inst", "/c", "dune.com")
+        self.storage.replace_binding_path("inst", "/d", None, "content")
+        self.assertEqual({"_id": "inst", "app_host": "app.host.com",
+                          "paths": [{"path": "/", "destination": "app.host.com"},
+                                    {"path": "/a.b", "destination": "dune.com", "content": None},
+                                    {"path": "/c", "destination": "dune.com", "content": None},
+                                    {"path": "/d", "destination": None, "content": "content"}]},
+                         self.storage.find_binding("inst"))
+        self.assertEqual(("dune.com", 1), self.storage.delete_binding_path("inst", "/a.b"))
+        self.storage.replace_binding_path("inst", "/c", "app.host.com")
+        self.assertEqual((None, 0), self.storage.delete_binding_path("inst", "/d"))
+        self.assertEqual(("app.host.com", 1), self.storage.delete_binding_path("inst", "/c"))
+        with self.assertRaises(storage.InstanceNotFoundError):
+            self.storage.delete_binding_path("inst", "/c")
+        binding = self.storage.db[self.storage.bindings_collection].find_one({"_id": "inst"})
+        self.assertEqual({"app%2Ehost%2Ecom": 1}, binding["destinations"])
+
+    def test_binding_legacy_paths_are_migrated(self):
+        self.storage.db[self.storage.bindings_collection].insert({
+            "_id": "inst", "app_host": "app.host.com",
+            "paths": [{"path": "/", "destination": "app.host.com"},
+                      {"path": "/a", "destination": "dune.com", "content": None},
+                      {"path": "/b", "destination": "dune.com", "content": None}]})
+        self.assertEqual(["/", "/a", "/b"], [p["path"] for p in self.storage.find_binding("inst")["paths"]])
+        self.assertEqual(("dune.com", 1), self.storage.delete_binding_path("inst", "/a"))
+        self.storage.replace_binding_path("inst", "/c", "other.com")
+        self.assertEqual({"_id": "inst", "app_host": "app.host.com",
+                          "paths": [{"path": "/", "destination": "app.host.com"},
+                                    {"path": "/b", "destination": "dune.com", "content": None},
+                                    {"path": "/c", "destination": "other.com", "content": None}]},
+                         self.storage.find_binding("inst"))
+        self.storage.db[self.storage.bindings_collection].insert({
+            "_id": "other", "paths": [{"path": "/", "destination": "app.host.com"}]})
+        self.assertEqual(1, self.storage.migrate_bindings())
+        self.assertEqual(0, self.storage.migrate_bindings())
+        binding = self.storage.db[self.storage.bindings_collection].find_one({"_id": "other"})
+        self.assertNotIn("paths", binding)
+        self.assertEqual({"app%2Ehost%2Ecom": 1}, binding["destinations"])